@@ -1,3 +1,6 @@
+import heapq
+from collections import OrderedDict, deque
+
 from aimacode.logic import PropKB
 from aimacode.planning import Action
 from aimacode.search import (
@@ -7,7 +10,9 @@ from aimacode.utils import expr
 from lp_utils import (
     FluentState, encode_state, decode_state,
 )
-from my_planning_graph import PlanningGraph
+from my_planning_graph import (
+    IndexedPlanningGraph, PlanningGraph, RelaxedPlanningGraph, batch_levelsum,
+)
 
 
 class AirCargoProblem(Problem):
@@ -32,6 +37,84 @@ class AirCargoProblem(Problem):
         self.planes = planes
         self.airports = airports
         self.actions_list = self.get_actions()
+        self.fluent_terms = [(f.op, tuple(str(a) for a in f.args)) for f in self.state_map]
+        self.fluent_index = {term: i for i, term in enumerate(self.fluent_terms)}
+        self.symmetry_classes = self.get_symmetry_classes()
+        self.relaxed_graphs = OrderedDict()
+        self.relaxed_graphs_size = 10000
+        self.last_planning_graph = None
+        self.pg_profiler = None
+
+    def get_symmetry_classes(self):
+        '''
+        Group the planes and the cargos into classes of interchangeable objects.
+        Two objects of the same type are interchangeable when swapping their
+        names maps the goal onto itself; the ground action list is generated for
+        every combination of objects, so it is always invariant under such a
+        swap.  Airports are never permuted.
+
+        Returns:
+        ----------
+        list<list<str>>
+            one sorted list of object names per class with at least two members,
+            planes' classes first
+        '''
+        goal_terms = set((g.op, tuple(str(a) for a in g.args)) for g in self.goal)
+
+        def swap_preserves_goal(obj1, obj2):
+            rename = {obj1: obj2, obj2: obj1}
+            swapped = set((op, tuple(rename.get(a, a) for a in args)) for op, args in goal_terms)
+            return swapped == goal_terms
+
+        classes = []
+        for objects in (self.planes, self.cargos):
+            groups = []
+            for obj in sorted(objects):
+                for group in groups:
+                    if swap_preserves_goal(group[0], obj):
+                        group.append(obj)
+                        break
+                else:
+                    groups.append([obj])
+            classes.extend(group for group in groups if len(group) > 1)
+        return classes
+
+    def canonical_state(self, state: str) -> str:
+        """ Return the canonical representative of the state's symmetry class
+
+        The objects of every symmetry class are ranked by the fluents they appear
+        in and renamed in rank order, so states that differ only by a renaming of
+        interchangeable planes or cargos share the same canonical state.  The
+        result is always the image of `state` under a goal-preserving renaming,
+        so a search may treat it as a duplicate of any state with the same key.
+
+        :param state: str
+            state represented as T/F string of mapped fluents (state variables)
+        :return: str
+            canonical state in the same T/F encoding
+        """
+        if not self.symmetry_classes:
+            return state
+        pos = [self.fluent_terms[i] for i, value in enumerate(state) if value == 'T']
+        rename = {}
+        labels = {obj: '#{}'.format(k) for k, group in enumerate(self.symmetry_classes) for obj in group}
+        for group in self.symmetry_classes:
+            def signature(obj):
+                sig = []
+                for op, args in pos:
+                    if obj in args:
+                        sig.append((op, tuple('*' if a == obj else rename.get(a, labels.get(a, a))
+                                              for a in args)))
+                return sorted(sig)
+            for obj, new_name in zip(sorted(group, key=lambda o: (signature(o), o)), group):
+                rename[obj] = new_name
+        new_state = ['F'] * len(state)
+        for op, args in pos:
+            idx = self.fluent_index.get((op, tuple(rename.get(a, a) for a in args)))
+            if idx is None:
+                return state
+            new_state[idx] = 'T'
+        return ''.join(new_state)
 
     def get_actions(self):
         '''
@@ -195,11 +278,89 @@ class AirCargoProblem(Problem):
         out from the current state in order to satisfy each individual goal
         condition.
         '''
-        # requires implemented PlanningGraph class
-        pg = PlanningGraph(self, node.state)
+        # requires implemented PlanningGraph class; the level sum only needs the first level
+        # of each goal, so the graph stops at the goals and skips the mutex relations
+        pg = self.planning_graph(node.state)
         pg_levelsum = pg.h_levelsum()
         return pg_levelsum
 
+    def planning_graph(self, state: str, mutex=False) -> PlanningGraph:
+        '''
+        Goal-directed planning graph of a state.  The graph of the last state
+        asked for is kept, so several heuristics can be evaluated on one node
+        without rebuilding it; a graph without mutexes is rebuilt when one
+        with mutexes is requested.  Graphs are profiled into `pg_profiler`
+        (a PgProfiler) when it is set.
+        '''
+        pg = self.last_planning_graph
+        if pg is None or pg.state != state or (mutex and not pg.mutex):
+            pg = PlanningGraph(self, state, goal_directed=True, mutex=mutex, profiler=self.pg_profiler)
+            self.last_planning_graph = pg
+        return pg
+
+    def h_pg_maxlevel(self, node: Node):
+        '''
+        This heuristic uses a planning graph representation of the problem
+        state space to estimate the number of actions as the largest level
+        cost of the individual goal conditions.
+        '''
+        return self.planning_graph(node.state).h_maxlevel()
+
+    def h_pg_setlevel(self, node: Node):
+        '''
+        This heuristic uses a planning graph representation of the problem
+        state space to estimate the number of actions as the first level at
+        which all goal conditions hold with no pair of them mutually exclusive.
+        '''
+        return self.planning_graph(node.state, mutex=True).h_setlevel()
+
+    def h_pg_ff(self, node: Node):
+        '''
+        This heuristic uses a planning graph representation of the problem
+        state space to estimate the number of actions as the length of a
+        relaxed plan (ignoring delete effects) extracted from the graph.
+        '''
+        return self.planning_graph(node.state).h_ff()
+
+    def h_pg_levelsum_indexed(self, node: Node):
+        '''
+        Same estimate as h_pg_levelsum, computed on the integer-indexed
+        planning graph (IndexedPlanningGraph) instead of the object graph.
+        '''
+        pg = IndexedPlanningGraph(self, node.state)
+        return pg.h_levelsum()
+
+    def h_pg_levelsum_batch(self, nodes: list) -> list:
+        '''
+        h_pg_levelsum of a batch of nodes (for example all children of one
+        expansion), evaluated together with vectorized relaxed reachability.
+
+        :param nodes: list of Node
+        :return: list of int, in the order of `nodes`
+        '''
+        return batch_levelsum(self, [node.state for node in nodes]).tolist()
+
+    def h_pg_levelsum_incremental(self, node: Node):
+        '''
+        Same estimate as h_pg_levelsum, computed on relaxed reachability levels
+        that are repaired from the parent node's levels when those are still
+        cached (see RelaxedPlanningGraph.child).  The most recently used
+        `relaxed_graphs_size` graphs are kept in `relaxed_graphs`.
+        '''
+        pg = self.relaxed_graphs.get(node.state)
+        if pg is None:
+            parent = self.relaxed_graphs.get(node.parent.state) if node.parent is not None else None
+            if parent is not None:
+                pg = parent.child(node.state)
+            else:
+                pg = RelaxedPlanningGraph(self, node.state)
+            self.relaxed_graphs[node.state] = pg
+            if len(self.relaxed_graphs) > self.relaxed_graphs_size:
+                self.relaxed_graphs.popitem(last=False)
+        else:
+            self.relaxed_graphs.move_to_end(node.state)
+        return pg.h_levelsum()
+
     def h_ignore_preconditions(self, node: Node):
         '''
         This heuristic estimates the minimum number of actions that must be
@@ -236,6 +397,66 @@ class AirCargoProblem(Problem):
         return count
 
 
+def symmetric_breadth_first_search(problem):
+    """ Breadth-first graph search that detects duplicates by canonical state
+
+    Same search order as aimacode's breadth_first_search, except that states
+    which differ only by renaming interchangeable objects are expanded once.
+
+    :param problem: AirCargoProblem (or any problem with a canonical_state method)
+    :return: Node or None
+    """
+    node = Node(problem.initial)
+    if problem.goal_test(node.state):
+        return node
+    frontier = deque([node])
+    seen = {problem.canonical_state(node.state)}
+    while frontier:
+        node = frontier.popleft()
+        for child in node.expand(problem):
+            key = problem.canonical_state(child.state)
+            if key not in seen:
+                if problem.goal_test(child.state):
+                    return child
+                seen.add(key)
+                frontier.append(child)
+    return None
+
+
+def symmetric_astar_search(problem, h=None):
+    """ A* graph search that detects duplicates by canonical state
+
+    The heuristic must give the same value for symmetric states (all of the
+    AirCargoProblem heuristics do) for the search to stay optimal.
+
+    :param problem: AirCargoProblem (or any problem with a canonical_state method)
+    :param h: function of a Node returning the estimated cost to the goal
+    :return: Node or None
+    """
+    h = h or (lambda n: 0)
+    node = Node(problem.initial)
+    counter = 0
+    frontier = [(node.path_cost + h(node), counter, node)]
+    best_cost = {problem.canonical_state(node.state): node.path_cost}
+    explored = set()
+    while frontier:
+        _, _, node = heapq.heappop(frontier)
+        key = problem.canonical_state(node.state)
+        if key in explored:
+            continue
+        if problem.goal_test(node.state):
+            return node
+        explored.add(key)
+        for child in node.expand(problem):
+            child_key = problem.canonical_state(child.state)
+            if child_key in explored or best_cost.get(child_key, float('inf')) <= child.path_cost:
+                continue
+            best_cost[child_key] = child.path_cost
+            counter += 1
+            heapq.heappush(frontier, (child.path_cost + h(child), counter, child))
+    return None
+
+
 def air_cargo_p1() -> AirCargoProblem:
     cargos = ['C1', 'C2']
     planes = ['P1', 'P2']
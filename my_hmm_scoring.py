@@ -0,0 +1,411 @@
+import json
+import math
+import struct
+
+import numpy as np
+
+MODEL_FILE_MAGIC = b"HMMSTACK"
+MODEL_FILE_VERSION = 1
+MODEL_FILE_ALIGNMENT = 64
+WORD_PENALTY_MARGINS = 2.0
+
+
+class StackedHMMs(object):
+    '''
+    diagonal-covariance GaussianHMMs of many words stacked into padded arrays
+
+    Scoring a sequence evaluates the emission log-densities of every state of every model with
+    two matrix products and runs the forward recursion of all models together, instead of one
+    `GaussianHMM.score` call per word.  Models with fewer states are padded with states that
+    can neither be entered nor started in.  Words without a model (None) are left out and
+    listed in `missing`.
+
+    Attributes, for K stacked models with at most S states and F features:
+        words: list of the K words, in the order of the models dict
+        n_states: int array (K,)
+        log_startprob: (K, S), -inf for padding states
+        log_transmat: (K, S, S), -inf into and out of padding states
+        means, covars: (K, S, F); padding states have mean 0 and variance 1
+
+    `save` writes all arrays, including the precomputed emission terms, to one versioned file
+    that `load` maps into memory without copying, so processes loading the same file share
+    its pages and can score straight away.
+    '''
+
+    # arrays written by save, in file order
+    ARRAYS = ('n_states', 'startprob', 'transmat', 'means', 'covars', 'log_startprob', 'log_transmat',
+              'padding', 'emission_const', 'emission_linear', 'emission_quadratic')
+
+    def __init__(self, models: dict):
+        self.words = [word for word, model in models.items() if model is not None]
+        self.missing = [word for word, model in models.items() if model is None]
+        fitted = [models[word] for word in self.words]
+        for word, model in zip(self.words, fitted):
+            if model.covariance_type != "diag":
+                raise ValueError("model of {} does not have diagonal covariances".format(word))
+        self.n_states = np.array([model.n_components for model in fitted], dtype=int)
+        K = len(fitted)
+        S = int(self.n_states.max()) if K else 0
+        F = fitted[0].means_.shape[1] if K else 0
+        self.startprob = np.zeros((K, S))
+        self.transmat = np.zeros((K, S, S))
+        self.means = np.zeros((K, S, F))
+        self.covars = np.ones((K, S, F))
+        for k, model in enumerate(fitted):
+            n = model.n_components
+            self.startprob[k, :n] = model.startprob_
+            self.transmat[k, :n, :n] = model.transmat_
+            self.means[k, :n] = model.means_
+            self.covars[k, :n] = model._covars_
+        with np.errstate(divide="ignore"):
+            self.log_startprob = np.log(self.startprob)
+            self.log_transmat = np.log(self.transmat)
+        self.padding = np.arange(S)[None, :] >= self.n_states[:, None]
+        self.prepare_emissions()
+        self.path = None
+
+    def __reduce__(self):
+        # a loaded bank is sent to worker processes as its path, so they map the same pages
+        if self.path is not None:
+            return (StackedHMMs.load, (self.path,))
+        return super().__reduce__()
+
+    def save(self, path: str):
+        """ write the stacked models to one contiguous file
+
+        Layout: the 8-byte magic, the header length as a little-endian uint64, a JSON header
+        with the version, the words and each array's dtype, shape and offset, then the arrays
+        in C order, each starting at a multiple of MODEL_FILE_ALIGNMENT bytes.
+        """
+        arrays = [np.ascontiguousarray(getattr(self, name)) for name in self.ARRAYS]
+        entries = []
+        offset = 0
+        for name, array in zip(self.ARRAYS, arrays):
+            entries.append({'name': name, 'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset})
+            offset += -(-array.nbytes // MODEL_FILE_ALIGNMENT) * MODEL_FILE_ALIGNMENT
+        header = json.dumps({'version': MODEL_FILE_VERSION, 'words': self.words, 'missing': self.missing,
+                             'arrays': entries}).encode()
+        start = _aligned(len(MODEL_FILE_MAGIC) + 8 + len(header))
+        with open(path, "wb") as f:
+            f.write(MODEL_FILE_MAGIC + struct.pack("<Q", len(header)) + header)
+            for entry, array in zip(entries, arrays):
+                f.write(b"\0" * (start + entry['offset'] - f.tell()))
+                f.write(array.tobytes())
+
+    @classmethod
+    def load(cls, path: str):
+        """ stacked models from a file written by save; the arrays are read-only views on a
+        memory map of the file
+
+        :raises ValueError: if the file is not a model file of a supported version
+        """
+        with open(path, "rb") as f:
+            magic = f.read(len(MODEL_FILE_MAGIC))
+            if magic != MODEL_FILE_MAGIC:
+                raise ValueError("{} is not a stacked HMM file".format(path))
+            size, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(size).decode())
+        if header['version'] != MODEL_FILE_VERSION:
+            raise ValueError("{} has unsupported version {}".format(path, header['version']))
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        start = _aligned(len(MODEL_FILE_MAGIC) + 8 + size)
+        stacked = cls.__new__(cls)
+        stacked.words = header['words']
+        stacked.missing = header['missing']
+        for entry in header['arrays']:
+            dtype = np.dtype(entry['dtype'])
+            count = int(np.prod(entry['shape'], dtype=np.int64))
+            first = start + entry['offset']
+            view = data[first:first + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+            setattr(stacked, entry['name'], view)
+        stacked.path = path
+        return stacked
+
+    def prepare_emissions(self):
+        """ precompute the terms of the diagonal Gaussian log-density
+
+        log N(x | mu, var) = const + x . (mu / var) + x**2 . (-1 / (2 var)), so the densities of
+        all (model, state) pairs for all frames are two matrix products plus a constant
+        """
+        K, S, F = self.means.shape
+        precision = 1.0 / self.covars
+        self.emission_const = -0.5 * (F * math.log(2 * math.pi) + np.log(self.covars).sum(axis=2)
+                                      + (self.means ** 2 * precision).sum(axis=2))
+        self.emission_const[self.padding] = -np.inf
+        self.emission_linear = (self.means * precision).reshape(K * S, F).T
+        self.emission_quadratic = (-0.5 * precision).reshape(K * S, F).T
+
+    def log_emissions(self, X):
+        """ emission log-densities of every frame under every state of every model
+
+        :param X: array (T, F) of feature frames
+        :return: array (T, K, S), -inf for padding states
+        """
+        X = np.asarray(X, dtype=float)
+        K, S, _ = self.means.shape
+        log_b = X @ self.emission_linear + (X ** 2) @ self.emission_quadratic
+        return log_b.reshape(len(X), K, S) + self.emission_const
+
+    def step(self, log_alpha, x):
+        """ one forward step of every model on a single frame, independent of the frames before
+
+        :param log_alpha: array (K, S) of forward log-variables, or None at the start of a sequence
+        :param x: array (F,), the next feature frame
+        :return: array (K, S), the updated forward log-variables
+        """
+        x = np.asarray(x, dtype=float)
+        K, S, _ = self.means.shape
+        log_b = (x @ self.emission_linear + x ** 2 @ self.emission_quadratic).reshape(K, S) + self.emission_const
+        if log_alpha is None:
+            return self.log_startprob + log_b
+        return logsumexp(log_alpha[:, :, None] + self.log_transmat, axis=1) + log_b
+
+    def forward(self, log_b):
+        """ forward recursion of all models over one sequence, in log space
+
+        :param log_b: array (T, K, S) from log_emissions
+        :return: array (T, K) of log P(x_1..x_t) under each model
+        """
+        log_alpha = self.log_startprob + log_b[0]
+        partial = np.empty(log_b.shape[:2])
+        partial[0] = logsumexp(log_alpha, axis=1)
+        for t in range(1, len(log_b)):
+            log_alpha = logsumexp(log_alpha[:, :, None] + self.log_transmat, axis=1) + log_b[t]
+            partial[t] = logsumexp(log_alpha, axis=1)
+        return partial
+
+    def score(self, X, lengths=None):
+        """ log-likelihood of the sequences in X under every model, like GaussianHMM.score
+
+        :param X: array (T, F) of feature frames
+        :param lengths: list of sequence lengths in X, one sequence if None
+        :return: array (K,) in the order of self.words
+        """
+        log_b = self.log_emissions(X)
+        total = np.zeros(len(self.words))
+        start = 0
+        for length in (lengths if lengths is not None else [len(log_b)]):
+            total += self.forward(log_b[start:start + length])[-1]
+            start += length
+        return total
+
+    def score_batch(self, Xlengths: list):
+        """ log-likelihoods of many items under every model
+
+        The emissions of all frames come from one pair of matrix products and the sequences
+        run through the forward recursion together, padded to the longest one.
+
+        :param Xlengths: list of (X, lengths) items, e.g. from SinglesData.get_item_Xlengths
+        :return: array (N, K) scoring item n under model self.words[k]
+        """
+        if not Xlengths:
+            return np.zeros((0, len(self.words)))
+        log_b = self.log_emissions(np.concatenate([X for X, _ in Xlengths]))
+        owners = [n for n, (_, lengths) in enumerate(Xlengths) for _ in lengths]
+        sizes = np.array([length for _, lengths in Xlengths for length in lengths])
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        # frame t of sequence q sits at row starts[q] + t; rows past its end are ignored
+        rows = np.minimum(starts[:, None] + np.arange(sizes.max())[None, :], len(log_b) - 1)
+        log_alpha = self.log_startprob + log_b[rows[:, 0]]
+        for t in range(1, sizes.max()):
+            step = logsumexp(log_alpha[:, :, :, None] + self.log_transmat, axis=2) + log_b[rows[:, t]]
+            active = (t < sizes)[:, None, None]
+            log_alpha = np.where(active, step, log_alpha)
+        totals = np.zeros((len(Xlengths), len(self.words)))
+        np.add.at(totals, owners, logsumexp(log_alpha, axis=2))
+        return totals
+
+    def score_pruned(self, X, lengths=None, beam=None):
+        """ log-likelihoods of X under every model, abandoning models that fall behind
+
+        All models advance frame by frame.  After each frame a model is dropped once its
+        forward log-likelihood so far falls more than `beam` below that of the model leading
+        so far, which is never dropped.  Only the evidence seen so far is compared: bounds on
+        the remaining frames from each model's highest emission density favour models with
+        small variances over models that fit better.  Dropped models score -inf.  beam=None
+        disables pruning and gives exactly the scores of `score`.
+
+        :param X: array (T, F) of feature frames
+        :param lengths: list of sequence lengths in X, one sequence if None
+        :param beam: float margin in log-likelihood, or None
+        :return: (scores, evaluated, saved) with scores an array (K,) in the order of self.words
+            and the numbers of frame-model evaluations done and skipped
+        """
+        X = np.asarray(X, dtype=float)
+        K, S, _ = self.means.shape
+        lengths = lengths if lengths is not None else [len(X)]
+        if beam is None:
+            return self.score(X, lengths), K * len(X), 0
+        active = np.arange(K)
+        done = np.zeros(K)
+        evaluated = 0
+        frame = 0
+        for length in lengths:
+            for t in range(length):
+                columns = (active[:, None] * S + np.arange(S)).ravel()
+                log_b = (X[frame] @ self.emission_linear[:, columns]
+                         + X[frame] ** 2 @ self.emission_quadratic[:, columns]).reshape(len(active), S)
+                log_b += self.emission_const[active]
+                if t == 0:
+                    log_alpha = self.log_startprob[active] + log_b
+                else:
+                    log_alpha = logsumexp(log_alpha[:, :, None] + self.log_transmat[active], axis=1) + log_b
+                evaluated += len(active)
+                frame += 1
+                partial = done[active] + logsumexp(log_alpha, axis=1)
+                # NaN scores (degenerate models) are dropped and never lead
+                ranking = np.where(np.isnan(partial), -np.inf, partial)
+                if len(active) > 1 and np.isfinite(ranking.max()):
+                    keep = ranking >= ranking.max() - beam
+                    active, log_alpha = active[keep], log_alpha[keep]
+            done[active] += logsumexp(log_alpha, axis=1)
+        scores = np.full(K, -np.inf)
+        scores[active] = done[active]
+        return scores, evaluated, K * len(X) - evaluated
+
+    def score_dict(self, X, lengths=None) -> dict:
+        """ log-likelihood of X under every stacked model, as word -> float """
+        return dict(zip(self.words, self.score(X, lengths).tolist()))
+
+
+def logsumexp(a, axis):
+    """ log(sum(exp(a))) along an axis; -inf where every term is -inf """
+    shift = a.max(axis=axis, keepdims=True)
+    shift[~np.isfinite(shift)] = 0.0
+    with np.errstate(divide="ignore"):
+        return np.log(np.exp(a - shift).sum(axis=axis)) + np.squeeze(shift, axis=axis)
+
+
+class CompositeHMM(object):
+    '''
+    all word models compiled into one block-diagonal HMM with shared emissions
+
+    The combined state space is the K x S grid of a StackedHMMs.  Transitions are kept as the
+    per-word (S, S) blocks, so words only connect through a non-emitting exit state (reachable
+    from every state, as a sequence may end in any state) and a non-emitting entry state that
+    leads into each word's start distribution.  States with identical Gaussians, e.g. of a
+    model stored under two words, share one emission component, so each frame's densities
+    are computed once per distinct component.
+
+    A word boundary must cost something: with word_penalty=0 any stretch of frames that
+    another word fits slightly better becomes a word of its own, and sentences decode into
+    many short fragments.  By default (word_penalty=None) each decoded sequence gets the
+    penalty from `automatic_penalty`, WORD_PENALTY_MARGINS times the mean per-frame margin
+    between its best and second-best fitting word, which follows the scale of the models'
+    log-likelihoods.  To tune it, decode sentences with known words for a few multiples of
+    that value: recognition errors from words split into fragments (insertions) call for a
+    more negative penalty, merged or dropped words (deletions) for one closer to zero.
+
+    :param models: dict of trained models as for recognize, or a StackedHMMs
+    :param word_penalty: float log-probability added at every word boundary in `decode`, or
+        None for the automatic penalty; negative values favour fewer, longer words
+    '''
+
+    def __init__(self, models, word_penalty=None):
+        self.stacked = models if isinstance(models, StackedHMMs) else StackedHMMs(models)
+        self.words = self.stacked.words
+        self.word_penalty = word_penalty
+        K, S, F = self.stacked.means.shape
+        real = ~self.stacked.padding.ravel()
+        gaussians = np.concatenate([self.stacked.means, self.stacked.covars], axis=2).reshape(K * S, 2 * F)
+        unique, component = np.unique(gaussians[real], axis=0, return_inverse=True)
+        self.component = np.zeros(K * S, dtype=int)
+        self.component[real] = component.ravel()
+        means, covars = unique[:, :F], unique[:, F:]
+        precision = 1.0 / covars
+        self.emission_const = np.full(K * S, -np.inf)
+        self.emission_const[real] = (-0.5 * (F * math.log(2 * math.pi) + np.log(covars).sum(axis=1)
+                                             + (means ** 2 * precision).sum(axis=1)))[component.ravel()]
+        self.emission_linear = (means * precision).T
+        self.emission_quadratic = (-0.5 * precision).T
+
+    @property
+    def n_components(self):
+        """ number of distinct emission components """
+        return self.emission_linear.shape[1]
+
+    def log_emissions(self, X):
+        """ emission log-densities of every frame under every composite state
+
+        :param X: array (T, F) of feature frames
+        :return: array (T, K, S), -inf for padding states
+        """
+        X = np.asarray(X, dtype=float)
+        K, S, _ = self.stacked.means.shape
+        log_b = X @ self.emission_linear + (X ** 2) @ self.emission_quadratic
+        return (log_b[:, self.component] + self.emission_const).reshape(len(X), K, S)
+
+    def score(self, X):
+        """ forward log-likelihood of one isolated sequence under every word, in one pass
+
+        :return: array (K,) in the order of self.words
+        """
+        return self.stacked.forward(self.log_emissions(X))[-1]
+
+    def viterbi(self, X):
+        """ Viterbi log-probability of one isolated sequence under every word, in one pass
+
+        :return: array (K,) of best state-path log-probabilities in the order of self.words
+        """
+        log_b = self.log_emissions(X)
+        delta = self.stacked.log_startprob + log_b[0]
+        for t in range(1, len(log_b)):
+            delta = (delta[:, :, None] + self.stacked.log_transmat).max(axis=1) + log_b[t]
+        return delta.max(axis=1)
+
+    def automatic_penalty(self, log_b):
+        """ word penalty used for a sequence when word_penalty is None
+
+        :param log_b: array (T, K, S) from log_emissions
+        :return: float, -WORD_PENALTY_MARGINS times the mean over the frames of the gap between
+            the best and second-best word's best state log-density (0.0 for fewer than 2 words)
+        """
+        if log_b.shape[1] < 2 or not len(log_b):
+            return 0.0
+        best = np.sort(log_b.max(axis=2), axis=1)
+        return -WORD_PENALTY_MARGINS * float(np.mean(best[:, -1] - best[:, -2]))
+
+    def decode(self, X):
+        """ continuous recognition of an unsegmented sequence of signs by token passing
+
+        One Viterbi pass runs over the composite states.  At every frame the best token
+        leaving any word, plus the word penalty, may enter any word through its start
+        distribution.  Each token carries its word history, so no lattice is stored.
+
+        :param X: array (T, F) of feature frames
+        :return: (list of (word, first frame, last frame), Viterbi log-probability)
+        """
+        log_b = self.log_emissions(X)
+        T, K, S = log_b.shape
+        if not T or not K:
+            return [], -np.inf
+        # history entries are (word index, first frame, previous entry or -1)
+        penalty = self.automatic_penalty(log_b) if self.word_penalty is None else self.word_penalty
+        history = [(k, 0, -1) for k in range(K)]
+        tokens = np.repeat(np.arange(K)[:, None], S, axis=1)
+        delta = self.stacked.log_startprob + log_b[0]
+        for t in range(1, T):
+            scores = delta[:, :, None] + self.stacked.log_transmat
+            previous = scores.argmax(axis=1)
+            within = np.take_along_axis(scores, previous[:, None, :], axis=1)[:, 0, :]
+            exit_state = np.unravel_index(np.argmax(delta), delta.shape)
+            entry = delta[exit_state] + penalty + self.stacked.log_startprob
+            enters = entry > within
+            entering = np.flatnonzero(enters.any(axis=1))
+            new_ids = np.full(K, -1)
+            new_ids[entering] = len(history) + np.arange(len(entering))
+            history.extend((k, t, tokens[exit_state]) for k in entering)
+            tokens = np.where(enters, new_ids[:, None], np.take_along_axis(tokens, previous, axis=1))
+            delta = np.where(enters, entry, within) + log_b[t]
+        end_state = np.unravel_index(np.argmax(delta), delta.shape)
+        segments = []
+        entry_id, last = tokens[end_state], T - 1
+        while entry_id >= 0:
+            k, first, entry_id = history[entry_id]
+            segments.append((self.words[k], first, last))
+            last = first - 1
+        return segments[::-1], float(delta[end_state])
+
+
+def _aligned(offset):
+    return -(-offset // MODEL_FILE_ALIGNMENT) * MODEL_FILE_ALIGNMENT
@@ -0,0 +1,79 @@
+import csv
+import math
+import os
+from collections import Counter, defaultdict
+
+SENTENCE_START = "<s>"
+SENTENCE_END = "</s>"
+
+
+def load_training_sentences(path=os.path.join('data', 'train_words.csv')) -> list:
+    """ Training sentences as word lists, one per video, words ordered by their first frame
+
+    :param path: csv file with at least the columns video, word and startframe
+    :return: list of lists of words, in video order
+    """
+    videos = defaultdict(list)
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            videos[int(row['video'])].append((int(row['startframe']), row['word']))
+    return [[word for _, word in sorted(videos[video])] for video in sorted(videos)]
+
+
+class NGramModel(object):
+    '''
+    word n-gram language model with interpolated absolute discounting
+
+    P(w | h) = max(c(h w) - D, 0) / c(h) + D * N(h) / c(h) * P(w | h'), where N(h) counts the
+    distinct words seen after history h and h' drops the oldest word of h.  The unigram level
+    is interpolated with a uniform distribution over the vocabulary plus one unknown word, so
+    every word gets a finite log-probability.  Sentences are padded with <s> and </s>.
+
+    :param sentences: list of lists of words, e.g. from load_training_sentences
+    :param n: int order of the model
+    :param discount: float D in (0, 1)
+    '''
+
+    def __init__(self, sentences: list, n=3, discount=0.75):
+        self.n = n
+        self.discount = discount
+        # counts[h][w] for every history h of length 0 .. n - 1
+        self.counts = defaultdict(Counter)
+        for sentence in sentences:
+            padded = [SENTENCE_START] * (n - 1) + list(sentence) + [SENTENCE_END]
+            for i in range(n - 1, len(padded)):
+                for order in range(n):
+                    self.counts[tuple(padded[i - order:i])][padded[i]] += 1
+        self.vocabulary = set(self.counts[()])
+        self.totals = {history: sum(followers.values()) for history, followers in self.counts.items()}
+        self.cache = {}
+
+    def prob(self, word: str, history=()) -> float:
+        """ probability of word following the history (only the last n - 1 words are used) """
+        history = tuple(history)[-(self.n - 1):] if self.n > 1 else ()
+        key = (word, history)
+        if key not in self.cache:
+            if history:
+                lower = self.prob(word, history[1:])
+            else:
+                lower = 1.0 / (len(self.vocabulary) + 1)
+            followers = self.counts.get(history)
+            if followers:
+                total = self.totals[history]
+                lower = (max(followers[word] - self.discount, 0) / total
+                         + self.discount * len(followers) / total * lower)
+            self.cache[key] = lower
+        return self.cache[key]
+
+    def log_prob(self, word: str, history=()) -> float:
+        """ natural log of prob, on the scale of the HMM log-likelihoods """
+        return math.log(self.prob(word, history))
+
+    def sentence_log_prob(self, sentence: list) -> float:
+        """ log-probability of a whole sentence, including its start and end """
+        history = [SENTENCE_START] * (self.n - 1)
+        total = 0.0
+        for word in list(sentence) + [SENTENCE_END]:
+            total += self.log_prob(word, history)
+            history.append(word)
+        return total
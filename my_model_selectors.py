@@ -1,22 +1,313 @@
+import hashlib
+import json
 import math
+import os
 import statistics
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from time import perf_counter
 
 import numpy as np
+from hmmlearn.base import ConvergenceMonitor
 from hmmlearn.hmm import GaussianHMM
 from sklearn.model_selection import KFold
 from asl_utils import combine_sequences
 
+WARM_START_FLOOR = 1e-3
+SEARCH_STRATEGIES = ('exhaustive', 'coarse', 'golden')
+# fit and scoring errors that the same data and settings would raise again, so they may be
+# remembered as failures; anything else (MemoryError, interrupts) is raised and not remembered
+REPEATABLE_FIT_ERRORS = (ValueError, np.linalg.LinAlgError)
+
+
+def fit_hmm(X, lengths, num_states, random_state=14, model_cache=None,
+            n_iter=1000, tol=0.01, init=None, fit_log=None):
+    """ GaussianHMM with diagonal covariances fitted on the data; raises if fitting fails
+
+    :param X: array of feature frames
+    :param lengths: list of sequence lengths in X
+    :param num_states: int, number of hidden states
+    :param random_state: int
+    :param model_cache: HMMModelCache, reused for identical data and settings when given
+    :param n_iter: int, maximum number of EM iterations
+    :param tol: float, EM stops once the log-likelihood gain per iteration is below this
+    :param init: GaussianHMM with num_states states whose parameters start EM (warm start)
+        instead of the usual k-means initialisation, which is used again if EM diverges
+    :param fit_log: list; if given, a dict describing this fit is appended to it (event 'fit',
+        num_states, seconds, EM iterations, converged, failed, cached and warm_start)
+    :return: GaussianHMM object
+    """
+    start = perf_counter()
+
+    def log_fit(hmm_model=None, failed=False, cached=False):
+        if fit_log is not None:
+            fitted = hmm_model is not None and not cached
+            fit_log.append({'event': 'fit', 'num_states': num_states, 'seconds': perf_counter() - start,
+                            'iterations': hmm_model.monitor_.iter if fitted else None,
+                            'converged': bool(hmm_model.monitor_.converged) if fitted else None,
+                            'failed': failed, 'cached': cached, 'warm_start': init is not None})
+
+    settings = {'n_components': num_states, 'covariance_type': "diag", 'n_iter': n_iter,
+                'tol': tol, 'random_state': random_state}
+    if model_cache is not None:
+        key_settings = dict(settings)
+        if init is not None:
+            key_settings['init'] = model_cache.key(
+                np.concatenate([init.startprob_, init.transmat_.ravel(), init.means_.ravel(),
+                                init._covars_.ravel()]), [])
+        key = model_cache.key(X, lengths, **key_settings)
+        try:
+            hmm_model = model_cache.load(key)
+        except KeyError:
+            pass
+        else:
+            log_fit(hmm_model, failed=hmm_model is None, cached=True)
+            if hmm_model is None:
+                raise ValueError("cached fit failure for {} states".format(num_states))
+            return hmm_model
+    try:
+        if init is None:
+            hmm_model = GaussianHMM(verbose=False, **settings)
+        else:
+            hmm_model = GaussianHMM(verbose=False, init_params="", **settings)
+            hmm_model.monitor_ = _WarmStartMonitor(tol, n_iter, False)
+            # states or transitions the initial model never used would stay at probability zero
+            # and can make EM degenerate on new data, so a little mass is spread over all of them
+            hmm_model.startprob_ = (1 - WARM_START_FLOOR) * init.startprob_ + WARM_START_FLOOR / num_states
+            hmm_model.transmat_ = (1 - WARM_START_FLOOR) * init.transmat_ + WARM_START_FLOOR / num_states
+            hmm_model.means_ = init.means_.copy()
+            hmm_model.covars_ = init._covars_.copy()
+        hmm_model.fit(X, lengths)
+        if init is not None and not np.isfinite(hmm_model.monitor_.history[-1]):
+            # a state the initial model fitted to almost no data may get none of the new data;
+            # its parameters then become NaN, so fall back to the usual initialisation
+            hmm_model = GaussianHMM(verbose=False, **settings).fit(X, lengths)
+    except Exception as error:
+        log_fit(failed=True)
+        if model_cache is not None and isinstance(error, REPEATABLE_FIT_ERRORS):
+            model_cache.store(key, None)
+        raise
+    log_fit(hmm_model)
+    if model_cache is not None:
+        model_cache.store(key, hmm_model)
+    return hmm_model
+
+
+class _WarmStartMonitor(ConvergenceMonitor):
+    # also stops EM as soon as the log-likelihood is no longer finite
+    @property
+    def converged(self):
+        return super().converged or (len(self.history) > 0 and not np.isfinite(self.history[-1]))
+
+
+class HMMModelCache(object):
+    '''
+    content-addressed on-disk cache of fitted diagonal-covariance GaussianHMMs
+
+    Entries are keyed by a hash of the training arrays and lengths and of every fit setting
+    (n_components, covariance type, iteration settings, seed), and hold only the parameter
+    arrays, so identical fits are shared between selectors, notebook reruns and processes.
+    Fits that failed with a ValueError or LinAlgError are cached too.  When the directory
+    grows beyond max_bytes the least recently used entries are evicted.  `stats` counts hits,
+    misses, stores and evictions.
+    '''
+
+    def __init__(self, directory: str, max_bytes=256 * 2 ** 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(X, lengths, **settings) -> str:
+        """ hex digest identifying the training data and fit settings """
+        X = np.ascontiguousarray(X)
+        digest = hashlib.sha256()
+        digest.update(json.dumps([X.dtype.str, X.shape, settings], sort_keys=True).encode())
+        digest.update(X.tobytes())
+        digest.update(np.asarray(lengths, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key: str):
+        """ cached model for the key
+
+        :return: GaussianHMM object, or None for a cached failure
+        :raises KeyError: if the key is not cached
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError):
+            self.stats['misses'] += 1
+            raise KeyError(key)
+        self.stats['hits'] += 1
+        os.utime(path)
+        if 'failed' in arrays:
+            return None
+        hmm_model = GaussianHMM(n_components=len(arrays['startprob']), covariance_type="diag")
+        hmm_model.startprob_ = arrays['startprob']
+        hmm_model.transmat_ = arrays['transmat']
+        hmm_model.means_ = arrays['means']
+        hmm_model.covars_ = arrays['covars']
+        return hmm_model
+
+    def store(self, key: str, hmm_model):
+        """ cache a fitted model (or None for a failed fit), then evict down to max_bytes """
+        if hmm_model is None:
+            arrays = {'failed': np.ones(1)}
+        else:
+            arrays = {'startprob': hmm_model.startprob_, 'transmat': hmm_model.transmat_,
+                      'means': hmm_model.means_, 'covars': hmm_model._covars_}
+        path = self.path(key)
+        partial = "{}.{}.tmp".format(path, os.getpid())
+        with open(partial, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(partial, path)
+        self.stats['stores'] += 1
+        self.evict()
+
+    def evict(self):
+        """ remove least recently used entries until the cache fits in max_bytes """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                try:
+                    info = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+            self.stats['evictions'] += 1
+
+
+class ModelBank(object):
+    '''
+    shared store of word models for model selection
+
+    Every (word, n_components) model is trained at most once, on the word's full data, and
+    the log-likelihood of every word's data under every model is computed at most once, so
+    selectors for different words (in particular SelectorDIC, which scores all the other
+    words) reuse each other's fits.  `fold_models` holds SelectorCV's fold models under
+    fold_key(word, n_components, training sequence indices).  Fits and scores that failed
+    with one of REPEATABLE_FIT_ERRORS are remembered as None; other errors are raised and the
+    fit or score is tried again on the next request.  Selectors using the bank must share its
+    random_state, n_iter and tol.
+    '''
+
+    def __init__(self, all_word_Xlengths: dict, random_state=14, model_cache=None,
+                 n_iter=1000, tol=0.01, fit_log=None):
+        self.hwords = all_word_Xlengths
+        self.random_state = random_state
+        self.model_cache = model_cache
+        self.n_iter = n_iter
+        self.tol = tol
+        self.fit_log = fit_log
+        self.models = {}
+        self.fold_models = {}
+        self.scores = {}
+
+    def __getstate__(self):
+        # the word data is not pickled; train_all_words rebinds it to each worker's shared views
+        state = self.__dict__.copy()
+        state['hwords'] = None
+        return state
+
+    def model(self, word: str, num_states: int):
+        """ model of the word with num_states states, trained on first use
+
+        :return: GaussianHMM object, or None if fitting failed
+        """
+        key = (word, num_states)
+        if key not in self.models:
+            warnings.filterwarnings("ignore", category=DeprecationWarning)
+            X, lengths = self.hwords[word]
+            try:
+                self.models[key] = fit_hmm(X, lengths, num_states, self.random_state, self.model_cache,
+                                           self.n_iter, self.tol, fit_log=self.fit_log)
+            except REPEATABLE_FIT_ERRORS:
+                self.models[key] = None
+        return self.models[key]
+
+    @staticmethod
+    def fold_key(word: str, num_states: int, train_indices) -> tuple:
+        """ fold_models key of the word's model with num_states states trained on the sequences
+        at train_indices
+        """
+        return word, num_states, tuple(int(i) for i in train_indices)
+
+    def score(self, model_word: str, num_states: int, data_word: str):
+        """ log-likelihood of data_word's data under model_word's model with num_states states
+
+        :return: float, or None if the model is missing or scoring failed
+        """
+        key = (model_word, num_states, data_word)
+        if key not in self.scores:
+            model = self.model(model_word, num_states)
+            logL = None
+            if model is not None:
+                X, lengths = self.hwords[data_word]
+                try:
+                    logL = model.score(X, lengths)
+                except REPEATABLE_FIT_ERRORS:
+                    pass
+            self.scores[key] = logL
+        return self.scores[key]
+
+    def likelihood_matrix(self, num_states: int):
+        """ log-likelihood of every word's data under every word's model with num_states states
+
+        :return: (list of words, array) where array[i, j] scores words[j] under the model of
+            words[i], NaN where unavailable
+        """
+        words = list(self.hwords)
+        matrix = np.full((len(words), len(words)), np.nan)
+        for i, model_word in enumerate(words):
+            for j, data_word in enumerate(words):
+                logL = self.score(model_word, num_states, data_word)
+                if logL is not None:
+                    matrix[i, j] = logL
+        return words, matrix
+
 
 class ModelSelector(object):
     '''
     base class for model selection (strategy design pattern)
+
+    `search` chooses how the candidate sizes between min_n_components and max_n_components
+    are visited (see search_sizes): 'exhaustive' tries them in order, stopping after `patience`
+    sizes in a row without improvement if patience is set; 'coarse' scores an evenly spaced
+    grid and then halves the step around the best size; 'golden' runs a golden-section search.
+    Only the exhaustive search is guaranteed to find the best size: 'coarse' and 'golden'
+    assume the criterion is unimodal in n (a single peak) and can settle on a local optimum
+    otherwise.  Criteria estimated from few sequences are often not unimodal; e.g. over
+    n = 3..15 golden picked 10 states where the exhaustive BIC sweep picked 3.  Each size
+    is fitted at most once per selector.
     '''
 
     def __init__(self, all_word_sequences: dict, all_word_Xlengths: dict, this_word: str,
                  n_constant=3,
                  min_n_components=2, max_n_components=10,
-                 random_state=14, verbose=False):
+                 random_state=14, verbose=False, model_bank=None, model_cache=None,
+                 n_iter=1000, tol=0.01, fit_log=None, search='exhaustive', patience=None):
+        if search not in SEARCH_STRATEGIES:
+            raise ValueError("unknown search strategy {}".format(search))
+        if model_bank is not None and (model_bank.random_state, model_bank.n_iter, model_bank.tol) != \
+                (random_state, n_iter, tol):
+            raise ValueError("the model bank was built with random_state={}, n_iter={}, tol={}".format(
+                model_bank.random_state, model_bank.n_iter, model_bank.tol))
         self.words = all_word_sequences
         self.hwords = all_word_Xlengths
         self.sequences = all_word_sequences[this_word]
@@ -27,21 +318,151 @@ class ModelSelector(object):
         self.max_n_components = max_n_components
         self.random_state = random_state
         self.verbose = verbose
+        self.model_bank = model_bank
+        self.model_cache = model_cache
+        self.n_iter = n_iter
+        self.tol = tol
+        self.fit_log = fit_log
+        self.search = search
+        self.patience = patience
+        self.fitted_models = {}
 
     def select(self):
         raise NotImplementedError
 
+    def search_sizes(self, evaluate):
+        """ best number of states by the search strategy
+
+        The coarse and golden searches skip sizes, so their result is only the exhaustive
+        sweep's result when the criterion has a single peak between min_n_components and
+        max_n_components.
+
+        :param evaluate: function from a list of sizes to a dict of size -> criterion value
+            (higher is better; None where the size could not be scored)
+        :return: (best size or None if no size was scored, dict of every evaluated size -> value)
+        """
+        low, high = self.min_n_components, self.max_n_components
+        scores = {}
+
+        def run(sizes):
+            todo = sorted(set(n for n in sizes if low <= n <= high and n not in scores))
+            if todo:
+                scores.update(evaluate(todo))
+
+        def value(n):
+            # unscored, NaN and -inf sizes never win
+            score = scores.get(n)
+            return -math.inf if score is None or math.isnan(score) else score
+
+        def best():
+            # the smallest size wins ties, as in the sweeps
+            return max(sorted(scores), key=value) if scores else None
+
+        if low > high:
+            # no size to try; the selectors then fall back to their default model
+            return None, scores
+        if self.search == 'exhaustive' and self.patience is None:
+            run(range(low, high + 1))
+        elif self.search == 'exhaustive':
+            waited = 0
+            for n in range(low, high + 1):
+                previous = value(best()) if scores else -math.inf
+                run([n])
+                waited = 0 if value(n) > previous else waited + 1
+                if waited >= self.patience:
+                    break
+        elif self.search == 'coarse':
+            step = max(1, (high - low) // 4)
+            run(list(range(low, high + 1, step)) + [high])
+            while step > 1:
+                step = (step + 1) // 2
+                centre = best()
+                run([centre - step, centre + step])
+            centre = best()
+            run([centre - 1, centre + 1])
+        else:
+            # golden-section search: each step drops the part of [a, b] beyond the worse of the
+            # two inner points, which loses the optimum if the criterion has another peak there
+            inverse_phi = (math.sqrt(5) - 1) / 2
+            a, b = low, high
+            while b - a > 2:
+                c = int(round(b - inverse_phi * (b - a)))
+                d = max(int(round(a + inverse_phi * (b - a))), c + 1)
+                run([c, d])
+                if value(c) >= value(d):
+                    b = d
+                else:
+                    a = c
+            run(range(a, b + 1))
+        n = best()
+        return (n if n is not None and value(n) > -math.inf else None), scores
+
+    def each_size(self, criterion):
+        """ evaluate function for search_sizes that applies criterion(n) to each size in turn;
+        failures are logged and give None
+        """
+        def evaluate(sizes):
+            scores = {}
+            for n in sizes:
+                try:
+                    scores[n] = criterion(n)
+                except:
+                    #if exception occurs, just continuing to next one
+                    self.log_failure(n)
+                    scores[n] = None
+            return scores
+        return evaluate
+
+    def log_failure(self, num_states):
+        """ record a failure swallowed by a selector (event 'failure') in fit_log, if there is one """
+        if self.fit_log is not None:
+            self.fit_log.append({'event': 'failure', 'num_states': num_states})
+
+    def fit(self, num_states):
+        """ model of this word with num_states states, trained on all of its data (taken from
+        the model bank when there is one); raises if fitting fails
+
+        :return: GaussianHMM object
+        """
+        if num_states in self.fitted_models:
+            if self.fitted_models[num_states] is None:
+                raise ValueError("fitting {} with {} states failed".format(self.this_word, num_states))
+            return self.fitted_models[num_states]
+        self.fitted_models[num_states] = None
+        if self.model_bank is None:
+            hmm_model = fit_hmm(self.X, self.lengths, num_states, self.random_state, self.model_cache,
+                                self.n_iter, self.tol, fit_log=self.fit_log)
+        else:
+            hmm_model = self.model_bank.model(self.this_word, num_states)
+            if hmm_model is None:
+                raise ValueError("no model for {} with {} states".format(self.this_word, num_states))
+        self.fitted_models[num_states] = hmm_model
+        return hmm_model
+
+    def score_word(self, hmm_model, num_states, word):
+        """ log-likelihood of a word's data under this word's model; raises if scoring fails
+
+        :return: float
+        """
+        if self.model_bank is None:
+            X, lengths = self.hwords[word]
+            return hmm_model.score(X, lengths)
+        logL = self.model_bank.score(self.this_word, num_states, word)
+        if logL is None:
+            raise ValueError("cannot score {} under {} with {} states".format(word, self.this_word, num_states))
+        return logL
+
     def base_model(self, num_states):
         # with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=DeprecationWarning)
         # warnings.filterwarnings("ignore", category=RuntimeWarning)
         try:
-            hmm_model = GaussianHMM(n_components=num_states, covariance_type="diag", n_iter=1000,
-                                    random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
+            hmm_model = self.fit(num_states)
             if self.verbose:
                 print("model created for {} with {} states".format(self.this_word, num_states))
             return hmm_model
         except:
+            self.log_failure(num_states)
             if self.verbose:
                 print("failure on {} with {} states".format(self.this_word, num_states))
             return None
@@ -75,32 +496,24 @@ class SelectorBIC(ModelSelector):
         :return: GaussianHMM object
         """
         warnings.filterwarnings("ignore", category=DeprecationWarning)
+        best_num_components, _ = self.search_sizes(self.each_size(self.bic_criterion))
+        if best_num_components is None:
+            # the default model is only fitted when no size could be scored
+            return self.base_model(self.n_constant)
+        return self.fit(best_num_components)
 
-        # setting a default model and score at the beginning
-        bic_score = 99999999999
-        saved_model = self.base_model(self.n_constant)
-        # iterating from min to max number of components
-        for i in range(self.min_n_components,self.max_n_components + 1):
-          try:
-             #training the model
-             hmm_model = GaussianHMM(n_components=i, covariance_type="diag", n_iter=1000,random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
-             # calculating to find the bic score
-             logL = hmm_model.score(self.X, self.lengths)
-             bic1 = -2 * logL
-             num_data_points = len(self.X)
-             num_features = len(self.X[0])
-             num_params = i * i + 2 * i * num_features - 1
-             bic2 = num_params * math.log(num_data_points)
-             bic_current = bic1 + bic2
-             #comparing the bic score with the previous one to look for a better one
-             if bic_current < bic_score:
-               saved_model = hmm_model
-               bic_score = bic_current
-          except:
-           #if exception occurs, just continuing to next one 
-           continue
-
-        return saved_model
+    def bic_criterion(self, i):
+        """ negated BIC score of the model with i states, so that higher is better """
+        #training the model
+        hmm_model = self.fit(i)
+        # calculating to find the bic score
+        logL = self.score_word(hmm_model, i, self.this_word)
+        bic1 = -2 * logL
+        num_data_points = len(self.X)
+        num_features = len(self.X[0])
+        num_params = i * i + 2 * i * num_features - 1
+        bic2 = num_params * math.log(num_data_points)
+        return -(bic1 + bic2)
 
 class SelectorDIC(ModelSelector):
     ''' select best model based on Discriminative Information Criterion
@@ -109,74 +522,272 @@ class SelectorDIC(ModelSelector):
     Document Analysis and Recognition, 2003. Proceedings. Seventh International Conference on. IEEE, 2003.
     http://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.58.6208&rep=rep1&type=pdf
     DIC = log(P(X(i)) - 1/(M-1)SUM(log(P(X(all but i))
+
+    Both terms are likelihoods under this word's model, so each candidate needs a single fit;
+    with a ModelBank the scores of the other words are shared between selectors.
     '''
 
     def select(self):
         warnings.filterwarnings("ignore", category=DeprecationWarning)
-        # having the default score and model at the beginning
-        dic_score = -99999999999
-        saved_model = self.base_model(self.n_constant)
-        # iterating through min to max number of components to find the best one
-        for i in range(self.min_n_components,self.max_n_components + 1):
-           try:
-             # getting the model
-             hmm_model = GaussianHMM(n_components=i, covariance_type="diag", n_iter=1000,random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
-             # getting the log likelihood of the current example
-             logL_i = hmm_model.score(self.X, self.lengths)
-           except:
-             # if fails, will continue to next word
-             continue
-           logL_rest = 0
-           # will get the model of all other examples to calculate dic score
-           for key in self.words:
-                if key == self.this_word:
-                  continue
-                X_temp, lengths_temp = self.hwords[key]
-                try:
-                  hmm_model_temp = GaussianHMM(n_components=i, covariance_type="diag", n_iter=1000,random_state=self.random_state, verbose=False).fit(X_temp, lengths_temp)
-                  # accumulating log likelihood of all examples
-                  logL_rest += hmm_model_temp.score(X_temp, lengths_temp)
-                except:
-                  continue
-           coeff = 1 / (len(self.words) -1 )
-           dic_current = logL_i - coeff * logL_rest
-           # comparing for the best score
-           if dic_current > dic_score:
-                saved_model = hmm_model
-                dic_score = dic_current
+        best_num_components, _ = self.search_sizes(self.each_size(self.dic_criterion))
+        if best_num_components is None:
+            # the default model is only fitted when no size could be scored
+            return self.base_model(self.n_constant)
+        return self.fit(best_num_components)
 
-        return saved_model
+    def dic_criterion(self, i):
+        """ DIC score of the model with i states, None if no other word could be scored """
+        # getting the model and the log likelihood of the current example
+        hmm_model = self.fit(i)
+        logL_i = self.score_word(hmm_model, i, self.this_word)
+        logL_rest = []
+        # scoring all other words under this word's model to calculate dic score
+        for key in self.words:
+            if key == self.this_word:
+                continue
+            try:
+                logL_rest.append(self.score_word(hmm_model, i, key))
+            except:
+                self.log_failure(i)
+                continue
+        if not logL_rest:
+            return None
+        return logL_i - np.mean(logL_rest)
 
 
 class SelectorCV(ModelSelector):
     ''' select best model based on average log Likelihood of cross-validation folds
 
+    The fold fits of all the sizes the search asks for at once (every size for an exhaustive
+    sweep) are submitted together to `executor` (any concurrent.futures executor, e.g. one
+    process pool shared by every word, see train_all_words), or run in turn without one.
+    Every fold is fitted from scratch.  warm_folds=True instead warm-starts the other folds
+    from the first fold's model, which skips their k-means initialisation but biases the
+    scores: the first fold's model was trained on their test sequences.
+    Only the winning size gets a model on the full data, warm-started from its fold model
+    with the best test log-likelihood per frame.
+    With a model_bank, fold models are fitted from scratch once and kept in the bank's
+    fold_models, and the final model is the bank's model.
     '''
 
+    def __init__(self, *args, n_folds=3, executor=None, warm_folds=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_folds = n_folds
+        self.executor = executor
+        self.warm_folds = warm_folds
+
     def select(self):
         warnings.filterwarnings("ignore", category=DeprecationWarning)
         #Initializing and choosing number of folds
-        best_logL = -9999999999
-        
-        split_method = KFold(n_splits=3, shuffle=False, random_state=None)
-        # Iteraing through min to max components
-        for i in range(self.min_n_components,self.max_n_components + 1):
-         logL = 0
-         try:
-          # combining the data after choosing the indexes for training and test data
-          for cv_train_idx, cv_test_idx in split_method.split(self.sequences):
-            X_train, lengths_train = combine_sequences(cv_train_idx,self.sequences)
-            X_test, lengths_test = combine_sequences(cv_test_idx,self.sequences)
-            # getting model and computing log likelihood
-            hmm_model = GaussianHMM(n_components=i, covariance_type="diag", n_iter=1000,random_state=self.random_state, verbose=False).fit(X_train, lengths_train)
-            logL += hmm_model.score(X_test, lengths_test)
-          logL = logL/3
-          # comparing for best model
-          if logL > best_logL :                                                                                                                                 
-              best_logL = logL                                                                                                                                    
-              best_model = GaussianHMM(n_components=i, covariance_type="diag", n_iter=1000,random_state=self.random_state, verbose=False).fit(self.X,self.lengths)
-         except:
+        if len(self.sequences) < self.n_folds:
+            return self.base_model(self.n_constant)
+        split_method = KFold(n_splits=self.n_folds, shuffle=False, random_state=None)
+        # combining the data after choosing the indexes for training and test data
+        splits = list(split_method.split(self.sequences))
+        folds = [combine_sequences(cv_train_idx, self.sequences) + combine_sequences(cv_test_idx, self.sequences)
+                 for cv_train_idx, cv_test_idx in splits]
+        best_fold_models = {}
+
+        def evaluate(sizes):
+            scores = {}
+            train_indices = [cv_train_idx for cv_train_idx, _ in splits]
+            for i, fold_results in zip(sizes, self.fold_results(map_function, folds, sizes, train_indices)):
+                if any(result is None for result in fold_results):
+                    self.log_failure(i)
+                    scores[i] = None
+                    continue
+                scores[i] = sum(fold_logL for fold_logL, _ in fold_results) / len(folds)
+                # folds differ in length, so their models are compared per test frame
+                best_fold = max(range(len(folds)), key=lambda f: fold_results[f][0] / sum(folds[f][3]))
+                best_fold_models[i] = fold_results[best_fold][1]
+            return scores
+
+        map_function = self.executor.map if self.executor is not None else map
+        best_num_components, scores = self.search_sizes(evaluate)
+        if best_num_components is None or None in scores.values():
             # return default model in case of exception
             return self.base_model(self.n_constant)
-        return best_model 
-        
+        if self.model_bank is not None:
+            return self.base_model(best_num_components)
+        try:
+            return fit_hmm(self.X, self.lengths, best_num_components, self.random_state, self.model_cache,
+                           self.n_iter, self.tol, init=best_fold_models[best_num_components],
+                           fit_log=self.fit_log)
+        except:
+            self.log_failure(best_num_components)
+            return self.base_model(best_num_components)
+
+    def fold_results(self, map_function, folds, sizes, train_indices=None):
+        """ fit and score every fold for every size
+
+        :param map_function: map or an executor's map, used to run _cv_fold
+        :param train_indices: training sequence indices of each fold, which key the fold models
+            in the model bank (required with a model_bank)
+        :return: list per size of lists per fold of (test logL, model), None where a fold failed
+        """
+        def run(fold_ids, inits):
+            return self.run_folds(map_function, [(folds[f], i, init) for i, init in zip(sizes, inits)
+                                                 for f in fold_ids])
+        if self.model_bank is not None:
+            return self.banked_fold_results(map_function, folds, sizes, train_indices)
+        if not self.warm_folds:
+            results = run(range(len(folds)), [None] * len(sizes))
+            return [results[k * len(folds):(k + 1) * len(folds)] for k in range(len(sizes))]
+        first = run([0], [None] * len(sizes))
+        rest = run(range(1, len(folds)), [result and result[1] for result in first])
+        width = len(folds) - 1
+        return [[first[k]] + rest[k * width:(k + 1) * width] for k in range(len(sizes))]
+
+    def banked_fold_results(self, map_function, folds, sizes, train_indices):
+        # fold models the bank already holds are only scored; the others are fitted from
+        # scratch through map_function and added to the bank
+        bank = self.model_bank
+        keys = {(i, f): bank.fold_key(self.this_word, i, train_indices[f])
+                for i in sizes for f in range(len(folds))}
+        missing = [(i, f) for (i, f), key in keys.items() if key not in bank.fold_models]
+        fitted = dict(zip(missing, self.run_folds(map_function, [(folds[f], i, None) for i, f in missing])))
+        results = []
+        for i in sizes:
+            results.append([])
+            for f, (_, _, X_test, lengths_test) in enumerate(folds):
+                if (i, f) in fitted:
+                    bank.fold_models[keys[i, f]] = fitted[i, f] and fitted[i, f][1]
+                    results[-1].append(fitted[i, f])
+                    continue
+                hmm_model = bank.fold_models[keys[i, f]]
+                result = None
+                if hmm_model is not None:
+                    try:
+                        result = hmm_model.score(X_test, lengths_test), hmm_model
+                    except REPEATABLE_FIT_ERRORS:
+                        pass
+                results[-1].append(result)
+        return results
+
+    def run_folds(self, map_function, jobs):
+        """ fit and score folds
+
+        :param jobs: list of (fold data, num_states, initial model or None)
+        :return: list of (test logL, model), None where a fold failed
+        """
+        args = [fold + (i, self.random_state, self.model_cache, self.n_iter, self.tol, init,
+                        self.fit_log is not None)
+                for fold, i, init in jobs]
+        results = []
+        if not args:
+            return results
+        for result, fits in map_function(_cv_fold, *zip(*args)):
+            results.append(result)
+            if self.fit_log is not None:
+                self.fit_log.extend(fits)
+        return results
+
+
+def _cv_fold(X_train, lengths_train, X_test, lengths_test, num_states, random_state, model_cache, n_iter, tol,
+             init=None, log_fits=False):
+    # one cross-validation fit; module level so that process pools can run it.  Returns the
+    # (test logL, model) result, or None if it failed with one of REPEATABLE_FIT_ERRORS (other
+    # errors are raised), and the fit_log records of the fit
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    fits = [] if log_fits else None
+    try:
+        hmm_model = fit_hmm(X_train, lengths_train, num_states, random_state, model_cache, n_iter, tol, init,
+                            fit_log=fits)
+        return (hmm_model.score(X_test, lengths_test), hmm_model), fits or []
+    except REPEATABLE_FIT_ERRORS:
+        return None, fits or []
+
+
+def train_all_words(all_word_sequences: dict, all_word_Xlengths: dict, model_selector,
+                    n_jobs=1, fold_jobs=1, **selector_kwargs) -> dict:
+    """ Select a model for every word, optionally spreading the words over worker processes
+
+    The feature arrays of all words are packed once into a shared memory block; each worker
+    attaches to it when it starts, rebuilds the `all_word_sequences` and `all_word_Xlengths`
+    dicts as views on that block and receives only word names, so no word data is pickled
+    per task.
+
+    :param all_word_sequences: dict, as returned by WordsData.get_all_sequences()
+    :param all_word_Xlengths: dict, as returned by WordsData.get_all_Xlengths()
+    :param model_selector: ModelSelector subclass, e.g. SelectorConstant or SelectorBIC
+    :param n_jobs: int, number of worker processes; 1 trains in this process, None uses all CPUs
+    :param fold_jobs: int, with n_jobs=1 and SelectorCV, size of one process pool created for all
+        words and passed to the selectors as their executor, so that the fold fits of each word
+        run in parallel; None uses all CPUs
+    :param selector_kwargs: passed on to the selector, e.g. n_constant=3 or max_n_components=15; a
+        model_bank is copied to each worker without its data and grows separately in each process
+    :return: dict of word -> trained model (None where selection failed), in word order
+    """
+    words = list(all_word_sequences)
+    if fold_jobs != 1:
+        if n_jobs != 1 or not issubclass(model_selector, SelectorCV):
+            raise ValueError("fold_jobs needs n_jobs=1 and a SelectorCV")
+        with ProcessPoolExecutor(max_workers=fold_jobs) as executor:
+            return train_all_words(all_word_sequences, all_word_Xlengths, model_selector,
+                                   executor=executor, **selector_kwargs)
+    if n_jobs == 1:
+        return {word: model_selector(all_word_sequences, all_word_Xlengths, word, **selector_kwargs).select()
+                for word in words}
+    block, layout = share_word_data(all_word_Xlengths)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_training_worker,
+                                 initargs=(block.name, layout, model_selector, selector_kwargs)) as executor:
+            return dict(zip(words, executor.map(_train_word, words)))
+    finally:
+        block.close()
+        block.unlink()
+
+
+def share_word_data(all_word_Xlengths: dict):
+    """ Copy the feature arrays of all words into one shared memory block
+
+    :param all_word_Xlengths: dict of word -> (X, lengths)
+    :return: (SharedMemory, layout) where layout holds the array shape and dtype and, per word,
+        the row range and sequence lengths of its data in the block
+    """
+    arrays = [np.asarray(X) for X, _ in all_word_Xlengths.values()]
+    dtype = np.result_type(*arrays)
+    rows = sum(len(X) for X in arrays)
+    shape = (rows, arrays[0].shape[1])
+    block = shared_memory.SharedMemory(create=True, size=max(rows * shape[1] * dtype.itemsize, 1))
+    data = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    words = {}
+    start = 0
+    for (word, (_, lengths)), X in zip(all_word_Xlengths.items(), arrays):
+        data[start:start + len(X)] = X
+        words[word] = (start, start + len(X), list(lengths))
+        start += len(X)
+    return block, {'shape': shape, 'dtype': dtype.str, 'words': words}
+
+
+def attach_word_data(name: str, layout: dict):
+    """ Rebuild the word dicts from a block made by share_word_data
+
+    :return: (SharedMemory, all_word_sequences, all_word_Xlengths); the arrays are views on the
+        block, which must stay open while they are used
+    """
+    block = shared_memory.SharedMemory(name=name)
+    data = np.ndarray(layout['shape'], dtype=np.dtype(layout['dtype']), buffer=block.buf)
+    sequences, Xlengths = {}, {}
+    for word, (start, stop, lengths) in layout['words'].items():
+        X = data[start:stop]
+        Xlengths[word] = (X, lengths)
+        bounds = np.cumsum([0] + lengths)
+        sequences[word] = [X[bounds[i]:bounds[i + 1]].tolist() for i in range(len(lengths))]
+    return block, sequences, Xlengths
+
+
+_training_worker = {}
+
+
+def _init_training_worker(name, layout, model_selector, selector_kwargs):
+    block, sequences, Xlengths = attach_word_data(name, layout)
+    if selector_kwargs.get('model_bank') is not None:
+        selector_kwargs['model_bank'].hwords = Xlengths
+    _training_worker.update(block=block, sequences=sequences, Xlengths=Xlengths,
+                            selector=model_selector, kwargs=selector_kwargs)
+
+
+def _train_word(word):
+    worker = _training_worker
+    return worker['selector'](worker['sequences'], worker['Xlengths'], word, **worker['kwargs']).select()
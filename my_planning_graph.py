@@ -1,3 +1,12 @@
+import heapq
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from time import perf_counter
+
+import numpy as np
+
 from aimacode.planning import Action
 from aimacode.search import Problem
 from aimacode.utils import expr
@@ -76,6 +85,22 @@ class PgNode_s(PgNode):
         self.literal = expr(self.symbol)
         if not self.is_pos:
             self.literal = expr('~{}'.format(self.symbol))
+        self.lid = None
+
+    @classmethod
+    def from_template(cls, template):
+        '''S-level node built from a PgLiteralTemplate without re-parsing the literal
+
+        :param template: PgLiteralTemplate
+        :return: PgNode_s with no parents, children or mutex, and `lid` set to the literal id
+        '''
+        node = cls.__new__(cls)
+        PgNode.__init__(node)
+        node.symbol = template.symbol
+        node.is_pos = template.is_pos
+        node.literal = template.literal
+        node.lid = template.lid
+        return node
 
     def show(self):
         '''helper print for debugging shows literal plus counts of parents, children, siblings
@@ -128,6 +153,24 @@ class PgNode_a(PgNode):
         self.is_persistent = False
         if self.prenodes == self.effnodes:
             self.is_persistent = True
+        self.aid = None
+
+    @classmethod
+    def from_template(cls, template):
+        '''A-level node built from a PgActionTemplate; `prenodes` and `effnodes` are the
+        template's shared frozensets of unconnected S-nodes and must not be modified
+
+        :param template: PgActionTemplate
+        :return: PgNode_a with no parents, children or mutex, and `aid` set to the action id
+        '''
+        node = cls.__new__(cls)
+        PgNode.__init__(node)
+        node.action = template.action
+        node.prenodes = template.prenodes
+        node.effnodes = template.effnodes
+        node.is_persistent = template.is_persistent
+        node.aid = template.aid
+        return node
 
     def show(self):
         '''helper print for debugging shows action plus counts of parents, children, siblings
@@ -198,33 +241,329 @@ def mutexify(node1: PgNode, node2: PgNode):
     node2.mutex.add(node1)
 
 
+UNREACHABLE = float('inf')
+
+class PgProfiler():
+    '''
+    Opt-in construction statistics for PlanningGraph.
+
+    Pass one profiler to every graph of a search run (PlanningGraph(..., profiler=p), or
+    set AirCargoProblem.pg_profiler).  For every graph it records, level by level, the node
+    counts, mutex pair counts, the sibling pairs tested and the tests and hits of each mutex
+    rule, and the wall time of each construction phase; report() aggregates them.
+
+    The A-level rules are 'serial', 'inconsistent_effects', 'interference', 'competing_needs'
+    (preconditions negating each other) and 'competing_parents' (mutex parent literals); the
+    S-level rules are 'negation' and 'inconsistent_support'.  Each pair is counted against the
+    rules in that order until one holds.  A profiled graph tests every pair in this process one
+    rule at a time, also when it has a mutex_pool, so its mutex phase times measure that path
+    rather than the pooled or the static-lookup one of an unprofiled graph.
+    '''
+
+    PHASES = ('create_graph', 'add_action_level', 'update_a_mutex', 'add_literal_level', 'update_s_mutex')
+
+    def __init__(self):
+        self.graphs = []
+
+    def start_graph(self, state: str):
+        '''open the record of a new graph; later calls apply to it'''
+        self.graphs.append({'state': state, 'time': dict.fromkeys(self.PHASES, 0.0), 'levels': []})
+
+    def level_record(self, level: int) -> dict:
+        '''record of a level of the current graph, created on first use'''
+        levels = self.graphs[-1]['levels']
+        while len(levels) <= level:
+            levels.append({'level': len(levels),
+                           's_nodes': 0, 'a_nodes': 0,
+                           's_mutex_pairs': 0, 'a_mutex_pairs': 0,
+                           's_pair_tests': 0, 'a_pair_tests': 0,
+                           'rules': {},
+                           'time': dict.fromkeys(self.PHASES[1:], 0.0)})
+        return levels[level]
+
+    def add_time(self, phase: str, level: int, seconds: float):
+        '''add the wall time of one phase'''
+        self.graphs[-1]['time'][phase] += seconds
+        if phase != 'create_graph':
+            self.level_record(level)['time'][phase] += seconds
+
+    def record_level(self, graph, level: int):
+        '''record node and mutex pair counts of S level `level` and of the A level before it'''
+        record = self.level_record(level)
+        record['s_nodes'] = len(graph.s_levels[level])
+        record['s_mutex_pairs'] = sum(len(node.mutex) for node in graph.s_levels[level]) // 2
+        if level > 0:
+            previous = self.level_record(level - 1)
+            previous['a_nodes'] = len(graph.a_levels[level - 1])
+            previous['a_mutex_pairs'] = sum(len(node.mutex) for node in graph.a_levels[level - 1]) // 2
+
+    def test_pairs(self, level: int, nodelist: list, rules):
+        ''' mutexify every pair of sibling nodes for which a rule holds, counting rule tests and hits
+
+        :param level: int
+        :param nodelist: list of PgNode_a or PgNode_s (siblings in the same level)
+        :param rules: sequence of (name, test) evaluated in order until one holds
+        '''
+        record = self.level_record(level)
+        kind = 'a' if nodelist and isinstance(nodelist[0], PgNode_a) else 's'
+        counts = [record['rules'].setdefault(name, {'tests': 0, 'hits': 0}) for name, _ in rules]
+        tests = [test for _, test in rules]
+        for i, n1 in enumerate(nodelist[:-1]):
+            for n2 in nodelist[i + 1:]:
+                record[kind + '_pair_tests'] += 1
+                for count, test in zip(counts, tests):
+                    count['tests'] += 1
+                    if test(n1, n2):
+                        count['hits'] += 1
+                        mutexify(n1, n2)
+                        break
+
+    def report(self) -> dict:
+        ''' statistics aggregated over all recorded graphs
+
+        :return: dict with
+            graphs: number of graphs (heuristic calls) recorded
+            time: total seconds per phase; time_per_graph: mean seconds per phase (create_graph
+                covers the constructor only; levels expanded on demand afterwards count in their phases)
+            levels: per level index, summed counts and phase times over the graphs reaching it
+            rules: total tests and hits per mutex rule
+        '''
+        totals = dict.fromkeys(self.PHASES, 0.0)
+        levels = []
+        rules = {}
+        for graph in self.graphs:
+            for phase, seconds in graph['time'].items():
+                totals[phase] += seconds
+            for record in graph['levels']:
+                if len(levels) <= record['level']:
+                    levels.append({'level': record['level'], 'graphs': 0,
+                                   'time': dict.fromkeys(self.PHASES[1:], 0.0)})
+                merged = levels[record['level']]
+                merged['graphs'] += 1
+                for key, value in record.items():
+                    if key in ('level', 'rules', 'time'):
+                        continue
+                    merged[key] = merged.get(key, 0) + value
+                for phase, seconds in record['time'].items():
+                    merged['time'][phase] += seconds
+                for name, count in record['rules'].items():
+                    total = rules.setdefault(name, {'tests': 0, 'hits': 0})
+                    total['tests'] += count['tests']
+                    total['hits'] += count['hits']
+        num_graphs = len(self.graphs)
+        return {'graphs': num_graphs,
+                'time': totals,
+                'time_per_graph': {phase: seconds / num_graphs if num_graphs else 0.0
+                                   for phase, seconds in totals.items()},
+                'levels': levels,
+                'rules': rules}
+
+
+class PgMutexPool():
+    '''
+    Process pool for the sibling mutex tests of large PlanningGraph levels.
+
+    A level is encoded as integer arrays (node flags, parent incidence, the static
+    relation and the mutex matrix of the parent level) placed in shared memory; each
+    worker evaluates the same rules as update_a_mutex / update_s_mutex on a block of
+    rows with matrix operations and returns its mutex pairs as an int32 array, so the
+    result is exactly the serial one.  Use it as a context manager, or call shutdown().
+    '''
+
+    def __init__(self, max_workers=None, min_nodes=500):
+        '''
+        :param max_workers: int, number of worker processes (default: number of CPUs)
+        :param min_nodes: int, levels with fewer nodes are tested serially
+        '''
+        self.workers = max_workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.min_nodes = min_nodes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def a_mutex_pairs(self, graph, nodelist: list, parents: list) -> np.ndarray:
+        ''' mutex pairs of an A level
+
+        :param graph: PlanningGraph
+        :param nodelist: list of PgNode_a, the level
+        :param parents: list of PgNode_s, the previous S level
+        :return: int32 array (pairs x 2) of positions i < j in nodelist
+        '''
+        aids = [node.aid for node in nodelist]
+        static = graph.index.static_mutex[np.ix_(aids, aids)]
+        if graph.serial:
+            static = static | graph.index.nonpersistent_pair[np.ix_(aids, aids)]
+        arrays = {'static': static,
+                  'pre': _incidence(nodelist, parents, lambda node: node.parents),
+                  'mutex': _mutex_matrix(parents)}
+        return self.run(_a_mutex_rows, arrays, len(nodelist))
+
+    def s_mutex_pairs(self, graph, nodelist: list, parents: list) -> np.ndarray:
+        ''' mutex pairs of an S level
+
+        :param graph: PlanningGraph
+        :param nodelist: list of PgNode_s, the level
+        :param parents: list of PgNode_a, the previous A level
+        :return: int32 array (pairs x 2) of positions i < j in nodelist
+        '''
+        arrays = {'fluent': np.array([node.lid % graph.index.num_fluents for node in nodelist], dtype=np.int64),
+                  'support': _incidence(nodelist, parents, lambda node: node.parents),
+                  'mutex': _mutex_matrix(parents)}
+        return self.run(_s_mutex_rows, arrays, len(nodelist))
+
+    def run(self, worker, arrays: dict, num_rows: int) -> np.ndarray:
+        '''share the arrays, test row blocks in the pool and gather the pairs'''
+        blocks = {}
+        try:
+            specs = {}
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks[name] = block
+                np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+                specs[name] = (block.name, array.shape, array.dtype.str)
+            step = max(1, -(-num_rows // (4 * self.workers)))
+            futures = [self.executor.submit(worker, specs, start, min(start + step, num_rows))
+                       for start in range(0, num_rows, step)]
+            pairs = [future.result() for future in futures]
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+        return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int32)
+
+
+def _incidence(nodelist: list, parents: list, links) -> np.ndarray:
+    '''uint8 matrix (parents x nodes) with a 1 where the parent is linked to the node'''
+    position = {id(node): i for i, node in enumerate(parents)}
+    matrix = np.zeros((len(parents), len(nodelist)), dtype=np.uint8)
+    for j, node in enumerate(nodelist):
+        for parent in links(node):
+            matrix[position[id(parent)], j] = 1
+    return matrix
+
+
+def _mutex_matrix(nodelist: list) -> np.ndarray:
+    '''uint8 matrix of the mutex relation between the nodes of a level'''
+    position = {id(node): i for i, node in enumerate(nodelist)}
+    matrix = np.zeros((len(nodelist), len(nodelist)), dtype=np.uint8)
+    for i, node in enumerate(nodelist):
+        for other in node.mutex:
+            matrix[i, position[id(other)]] = 1
+    return matrix
+
+
+def _attach(specs: dict):
+    '''open the shared blocks described by specs; returns (blocks, arrays)'''
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+    return blocks, arrays
+
+
+def _upper_pairs(mutex: np.ndarray, start: int) -> np.ndarray:
+    '''pairs (start + r, j) with j > start + r of a block of mutex rows'''
+    rows, cols = np.nonzero(mutex)
+    rows += start
+    keep = cols > rows
+    return np.stack((rows[keep], cols[keep]), axis=1).astype(np.int32)
+
+
+def _a_mutex_rows(specs: dict, start: int, stop: int) -> np.ndarray:
+    '''worker: mutex pairs of A-level rows start..stop (static and serial relation, competing needs)'''
+    blocks, arrays = _attach(specs)
+    try:
+        pre = arrays['pre'].astype(np.int32)
+        competing = (pre[:, start:stop].T @ arrays['mutex'].astype(np.int32) @ pre) > 0
+        return _upper_pairs(arrays['static'][start:stop] | competing, start)
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+
+
+def _s_mutex_rows(specs: dict, start: int, stop: int) -> np.ndarray:
+    '''worker: mutex pairs of S-level rows start..stop (negation, inconsistent support)'''
+    blocks, arrays = _attach(specs)
+    try:
+        fluent = arrays['fluent']
+        support = arrays['support'].astype(np.int32)
+        compatible = 1 - arrays['mutex'].astype(np.int32)
+        negation = fluent[start:stop, None] == fluent[None, :]
+        inconsistent = (support[:, start:stop].T @ compatible @ support) == 0
+        return _upper_pairs(negation | inconsistent, start)
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+
+
+PgLiteralTemplate = namedtuple('PgLiteralTemplate', ['lid', 'symbol', 'is_pos', 'literal'])
+PgActionTemplate = namedtuple('PgActionTemplate',
+                              ['aid', 'action', 'pre_ids', 'eff_ids', 'prenodes', 'effnodes', 'is_persistent'])
+
+
 class PlanningGraph():
     '''
     A planning graph as described in chapter 10 of the AIMA text. The planning
     graph can be used to reason about 
     '''
 
-    def __init__(self, problem: Problem, state: str, serial_planning=True):
+    def __init__(self, problem: Problem, state: str, serial_planning=True, goal_directed=False, mutex=True,
+                 profiler=None, mutex_pool=None):
         '''
         :param problem: PlanningProblem (or subclass such as AirCargoProblem or HaveCakeProblem)
         :param state: str (will be in form TFTTFF... representing fluent states)
         :param serial_planning: bool (whether or not to assume that only one action can occur at a time)
+        :param goal_directed: bool (stop construction as soon as every goal of the problem has appeared;
+            further levels are then added on demand by expand_level)
+        :param mutex: bool (whether or not to compute the mutex relations; heuristics that only need
+            the level at which literals first appear can skip them)
+        :param profiler: PgProfiler (records construction statistics of this graph when given)
+        :param mutex_pool: PgMutexPool (splits the mutex pair tests of large levels across processes;
+            not used when a profiler is given, which needs to count each rule)
         Instance variable calculated:
+            index: PgProblemIndex
+                integer ids and node templates shared by every graph built for the problem
             fs: FluentState
                 the state represented as positive and negative fluent literal lists
             all_actions: list of the PlanningProblem valid ground actions combined with calculated no-op actions
             s_levels: list of sets of PgNode_s, where each set in the list represents an S-level in the planning graph
             a_levels: list of sets of PgNode_a, where each set in the list represents an A-level in the planning graph
+            first_level: dict literal id -> index of the first S-level containing the literal
+            leveled: bool, True once the last two S levels contain the same literals
+            leveled_level: int, the first S level with the same literals as the one before, or None
         '''
         self.problem = problem
+        self.index = problem_index(problem)
+        self.state = state
         self.fs = decode_state(state, problem.state_map)
         self.serial = serial_planning
-        self.all_actions = self.problem.actions_list + self.noop_actions(self.problem.state_map)
+        self.goal_directed = goal_directed
+        self.mutex = mutex
+        self.all_actions = self.index.actions
         self.s_levels = []
         self.a_levels = []
-        self.create_graph()
-
-    def noop_actions(self, literal_list):
+        self.first_level = {}
+        self.leveled = False
+        self.leveled_level = None
+        self.profiler = profiler
+        self.mutex_pool = mutex_pool
+        if profiler is not None:
+            profiler.start_graph(state)
+        self.run_phase('create_graph', 0, self.create_graph)
+
+    @staticmethod
+    def noop_actions(literal_list):
         '''create persistent action for each possible fluent
 
         "No-Op" actions are virtual actions (i.e., actions that only exist in
@@ -261,6 +600,9 @@ class PlanningGraph():
         of a problem planning search, this will be the same as the initial state of the problem.  However,
         the planning graph can be built from any state in the Planning Problem
 
+        In goal-directed mode construction stops at the first S level holding every goal of the
+        problem, or once the graph levels off without them (the goals are then unreachable).
+
         This function should only be called by the class constructor.
 
         :return:
@@ -272,28 +614,83 @@ class PlanningGraph():
                 'Planning Graph already created; construct a new planning graph for each new state in the planning sequence')
 
         # initialize S0 to literals in initial state provided.
-        leveled = False
         level = 0
         self.s_levels.append(set())  # S0 set of s_nodes - empty to start
         # for each fluent in the initial state, add the correct literal PgNode_s
+        templates = self.index.literal_templates
         for literal in self.fs.pos:
-            self.s_levels[level].add(PgNode_s(literal, True))
+            self.s_levels[level].add(PgNode_s.from_template(templates[self.index.literal_id(literal, True)]))
         for literal in self.fs.neg:
-            self.s_levels[level].add(PgNode_s(literal, False))
+            self.s_levels[level].add(PgNode_s.from_template(templates[self.index.literal_id(literal, False)]))
         # no mutexes at the first level
+        for node in self.s_levels[level]:
+            self.first_level[node.lid] = level
+        if self.profiler is not None:
+            self.profiler.record_level(self, level)
 
         # continue to build the graph alternating A, S levels until last two S levels contain the same literals,
-        # i.e. until it is "leveled"
-        while not leveled:
-            self.add_action_level(level)
-            self.update_a_mutex(self.a_levels[level])
+        # i.e. until it is "leveled", or in goal-directed mode until all goals have appeared
+        goal_ids = [self.index.literal_id(goal) for goal in self.problem.goal]
+        while not self.leveled:
+            if self.goal_directed and all(lid in self.first_level for lid in goal_ids):
+                break
+            self.expand_level()
 
-            level += 1
-            self.add_literal_level(level)
-            self.update_s_mutex(self.s_levels[level])
+    def expand_level(self, force=False) -> bool:
+        ''' add the next A level and S level (with their mutexes unless disabled) to the graph
 
-            if self.s_levels[level] == self.s_levels[level - 1]:
-                leveled = True
+        :param force: bool (add the levels even if the literals have leveled off; the mutex
+            relations may keep shrinking for a few more levels)
+        :return: bool
+            False if the graph had already leveled off and nothing was added, True otherwise
+        '''
+        if self.leveled and not force:
+            return False
+        level = len(self.s_levels) - 1
+        self.run_phase('add_action_level', level, self.add_action_level, level)
+        if self.mutex:
+            self.run_phase('update_a_mutex', level, self.update_a_mutex, self.a_levels[level])
+
+        level += 1
+        self.run_phase('add_literal_level', level, self.add_literal_level, level)
+        if self.mutex:
+            self.run_phase('update_s_mutex', level, self.update_s_mutex, self.s_levels[level])
+
+        for node in self.s_levels[level]:
+            if node.lid not in self.first_level:
+                self.first_level[node.lid] = level
+        if self.s_levels[level] == self.s_levels[level - 1]:
+            self.leveled = True
+            if self.leveled_level is None:
+                self.leveled_level = level
+        if self.profiler is not None:
+            self.profiler.record_level(self, level)
+        return True
+
+    def run_phase(self, phase: str, level: int, method, *args):
+        ''' call one construction phase, timing it when the graph is profiled
+
+        :param phase: str, name of the phase in the profiler report
+        :param level: int, level the phase works on
+        :param method: bound method implementing the phase
+        :return: the method's return value
+        '''
+        if self.profiler is None:
+            return method(*args)
+        start = perf_counter()
+        result = method(*args)
+        self.profiler.add_time(phase, level, perf_counter() - start)
+        return result
+
+    def level_of(self, literal_id: int):
+        ''' level cost of a literal: the first S level containing it, expanding the graph on demand
+
+        :param literal_id: int (see PgProblemIndex.literal_id)
+        :return: int, or None if the literal is unreachable from the state
+        '''
+        while literal_id not in self.first_level and self.expand_level():
+            pass
+        return self.first_level.get(literal_id)
 
     def add_action_level(self, level):
         ''' add an A (action) level to the Planning Graph
@@ -304,26 +701,25 @@ class PlanningGraph():
         :return:
             adds A nodes to the current level in self.a_levels[level]
         '''
-        # TODO add action A level to the planning graph as described in the Russell-Norvig text
-        # 1. determine what actions to add and create those PgNode_a objects
-        # 2. connect the nodes to the previous S literal level
-        # for example, the A0 level will iterate through all possible actions for the problem and add a PgNode_a to a_levels[0]
-        #   set iff all prerequisite literals for the action hold in S0.  This can be accomplished by testing
-        #   to see if a proposed PgNode_a has prenodes that are a subset of the previous S level.  Once an
-        #   action node is added, it MUST be connected to the S node instances in the appropriate s_level set.
+        # count the satisfied preconditions of every action through the literal -> action map of the
+        # problem index; an action is added iff all of its preconditions hold in the S level, and it is
+        # connected to the S node instances of that level by direct lookup
+        index = self.index
+        s_nodes = {node.lid: node for node in self.s_levels[level]}
+        satisfied = [0] * len(index.actions)
+        for lid in s_nodes:
+            for aid in index.precond_actions[lid]:
+                satisfied[aid] += 1
 
         self.a_levels.append(set())
-        for action in self.all_actions:
-           #is_possible = False
-           anode = PgNode_a(action)
-           for clause in anode.prenodes:
-              for snode in self.s_levels[level]:
-                 if clause == snode:
-                      #if snode.is_pos :
-                      #is_possible = True
-                      self.a_levels[level].add(anode)
-                      snode.children.add(anode)
-                      anode.parents.add(snode)
+        for aid, pre_ids in enumerate(index.pre_ids):
+            if satisfied[aid] == len(pre_ids):
+                anode = PgNode_a.from_template(index.action_templates[aid])
+                self.a_levels[level].add(anode)
+                for lid in pre_ids:
+                    snode = s_nodes[lid]
+                    snode.children.add(anode)
+                    anode.parents.add(snode)
 
     def add_literal_level(self, level):
         ''' add an S (literal) level to the Planning Graph
@@ -334,21 +730,18 @@ class PlanningGraph():
         :return:
             adds S nodes to the current level in self.s_levels[level]
         '''
-        # TODO add literal S level to the planning graph as described in the Russell-Norvig text
-        # 1. determine what literals to add
-        # 2. connect the nodes
-        # for example, every A node in the previous level has a list of S nodes in effnodes that represent the effect
-        #   produced by the action.  These literals will all be part of the new S level.  Since we are working with sets, they
-        #   may be "added" to the set without fear of duplication.  However, it is important to then correctly create and connect
-        #   all of the new S nodes as children of all the A nodes that could produce them, and likewise add the A nodes to the
-        #   parent sets of the S nodes
-
-        self.s_levels.append(set())
-        for anode in self.a_levels[level-1]:
-           for literal in anode.effnodes:
-               self.s_levels[level].add(literal)
-               anode.children.add(literal)
-               literal.parents.add(anode)
+        # every effect of an action in the previous A level becomes one shared S node of this level,
+        # created from the problem's literal template and connected to all of the actions producing it
+        templates = self.index.literal_templates
+        s_nodes = {}
+        for anode in self.a_levels[level - 1]:
+            for lid in self.index.action_templates[anode.aid].eff_ids:
+                snode = s_nodes.get(lid)
+                if snode is None:
+                    snode = s_nodes[lid] = PgNode_s.from_template(templates[lid])
+                anode.children.add(snode)
+                snode.parents.add(anode)
+        self.s_levels.append(set(s_nodes.values()))
 
     def update_a_mutex(self, nodeset):
         ''' Determine and update sibling mutual exclusion for A-level nodes
@@ -365,15 +758,43 @@ class PlanningGraph():
         :return:
             mutex set in each PgNode_a in the set is appropriately updated
         '''
+        # inconsistent effects, interference and the precondition-negation half of competing needs
+        # depend only on the two actions; they are looked up in the static relation cached on the
+        # problem index, leaving only the competing parents test to be evaluated per graph
         nodelist = list(nodeset)
+        if self.profiler is not None:
+            self.profiler.test_pairs(len(self.a_levels) - 1, nodelist, (
+                ('serial', self.serialize_actions),
+                ('inconsistent_effects', self.static_relation_test('inconsistent_effects')),
+                ('interference', self.static_relation_test('interference')),
+                ('competing_needs', self.static_relation_test('competing_needs')),
+                ('competing_parents', self.competing_parents_mutex)))
+            return
+        if self.mutex_pool is not None and len(nodelist) >= self.mutex_pool.min_nodes:
+            parents = list(self.s_levels[len(self.a_levels) - 1])
+            for i, j in self.mutex_pool.a_mutex_pairs(self, nodelist, parents):
+                mutexify(nodelist[i], nodelist[j])
+            return
+        static_mutex_ids = self.index.static_mutex_ids
         for i, n1 in enumerate(nodelist[:-1]):
+            static = static_mutex_ids[n1.aid]
             for n2 in nodelist[i + 1:]:
                 if (self.serialize_actions(n1, n2) or
-                        self.inconsistent_effects_mutex(n1, n2) or
-                        self.interference_mutex(n1, n2) or
-                        self.competing_needs_mutex(n1, n2)):
+                        n2.aid in static or
+                        self.competing_parents_mutex(n1, n2)):
                     mutexify(n1, n2)
 
+    def static_relation_test(self, name: str):
+        '''
+        Pair test against one static relation of the problem index (see
+        PgProblemIndex.static_relations), used to count the rules separately when profiling.
+
+        :param name: str, 'inconsistent_effects', 'interference' or 'competing_needs'
+        :return: function (PgNode_a, PgNode_a) -> bool
+        '''
+        relation = self.index.static_relations[name]
+        return lambda node_a1, node_a2: bool(relation[node_a1.aid, node_a2.aid])
+
     def serialize_actions(self, node_a1: PgNode_a, node_a2: PgNode_a) -> bool:
         '''
         Test a pair of actions for mutual exclusion, returning True if the
@@ -411,6 +832,10 @@ class PlanningGraph():
            for fluent2 in node_a2.action.effect_rem:
               if fluent1 == fluent2:
                 return True
+        for fluent2 in node_a2.action.effect_add:
+           for fluent1 in node_a1.action.effect_rem:
+              if fluent1 == fluent2:
+                return True
         return False
 
     def interference_mutex(self, node_a1: PgNode_a, node_a2: PgNode_a) -> bool:
@@ -428,18 +853,15 @@ class PlanningGraph():
         :return: bool
         '''
 
-        # test for Interference between nodes 
-        for fluent1 in node_a1.action.effect_add:
-           for fluent2 in node_a2.action.precond_pos:
-              if fluent1 == fluent2:
-                return True
-
-        
-        for fluent2 in node_a2.action.effect_add:
-           for fluent1 in node_a1.action.precond_pos:
-              if fluent1 == fluent2:
-                return True
-
+        # test for Interference between nodes: a removed fluent that the other action requires,
+        # or an added fluent that the other action requires to be false
+        for node1, node2 in ((node_a1, node_a2), (node_a2, node_a1)):
+            for fluent in node1.action.effect_rem:
+                if fluent in node2.action.precond_pos:
+                    return True
+            for fluent in node1.action.effect_add:
+                if fluent in node2.action.precond_neg:
+                    return True
         return False
 
     def competing_needs_mutex(self, node_a1: PgNode_a, node_a2: PgNode_a) -> bool:
@@ -463,10 +885,22 @@ class PlanningGraph():
               if fluent1 == fluent2:
                 return True
 
+        return self.competing_parents_mutex(node_a1, node_a2)
+
+    def competing_parents_mutex(self, node_a1: PgNode_a, node_a2: PgNode_a) -> bool:
+        '''
+        Test a pair of actions for the state-dependent half of competing needs,
+        returning True if a parent S-node of one action is mutex with a parent
+        S-node of the other action in the previous S level.
+
+        :param node_a1: PgNode_a
+        :param node_a2: PgNode_a
+        :return: bool
+        '''
         for parent1 in node_a1.parents:
-           for parent2 in node_a2.parents:
-              if parent1.is_mutex(parent2):
-                return True 
+            for parent2 in node_a2.parents:
+                if parent1.is_mutex(parent2):
+                    return True
         return False
 
     def update_s_mutex(self, nodeset: set):
@@ -483,6 +917,16 @@ class PlanningGraph():
             mutex set in each PgNode_a in the set is appropriately updated
         '''
         nodelist = list(nodeset)
+        if self.profiler is not None:
+            self.profiler.test_pairs(len(self.s_levels) - 1, nodelist, (
+                ('negation', self.negation_mutex),
+                ('inconsistent_support', self.inconsistent_support_mutex)))
+            return
+        if self.mutex_pool is not None and len(nodelist) >= self.mutex_pool.min_nodes:
+            parents = list(self.a_levels[len(self.s_levels) - 2])
+            for i, j in self.mutex_pool.s_mutex_pairs(self, nodelist, parents):
+                mutexify(nodelist[i], nodelist[j])
+            return
         for i, n1 in enumerate(nodelist[:-1]):
             for n2 in nodelist[i + 1:]:
                 if self.negation_mutex(n1, n2) or self.inconsistent_support_mutex(n1, n2):
@@ -547,19 +991,677 @@ class PlanningGraph():
         :return: int
         '''
         level_sum = 0
+        # for each goal in the problem, determine the level cost, then add them together
+        for this_goal in self.problem.goal:
+            level = self.level_of(self.index.literal_id(this_goal))
+            if level is not None:
+                level_sum += level
+        return level_sum
+
+    def h_maxlevel(self) -> int:
+        '''The largest level cost of the individual goals (admissible)
 
+        :return: int
+        '''
+        level_max = 0
         for this_goal in self.problem.goal:
-           dont_exit = 1
-           this_node = PgNode_s(this_goal, True)
-           for this_level in range(0,len(self.s_levels)):
-              if dont_exit == 1:
-                for this_level_element in self.s_levels[this_level]:
-                   if this_node ==  this_level_element:
-                     level_sum += this_level
-                     dont_exit = 0
-                     break
-              else:
-                   break 
-        # TODO implement
-        # for each goal in the problem, determine the level cost, then add them together
+            level = self.level_of(self.index.literal_id(this_goal))
+            if level is not None:
+                level_max = max(level_max, level)
+        return level_max
+
+    def h_setlevel(self):
+        '''The first level at which all goals appear with no pair of them mutex (admissible).
+        Requires a graph built with mutex=True.
+
+        :return: int, or UNREACHABLE if the goals can never hold together
+        '''
+        if not self.mutex:
+            raise ValueError('h_setlevel needs a planning graph built with mutex=True')
+        goal_ids = []
+        level = 0
+        for this_goal in self.problem.goal:
+            lid = self.index.literal_id(this_goal)
+            goal_level = self.level_of(lid)
+            if goal_level is None:
+                return UNREACHABLE
+            goal_ids.append(lid)
+            level = max(level, goal_level)
+        while True:
+            while len(self.s_levels) <= level:
+                self.expand_level(force=True)
+            nodes = {node.lid: node for node in self.s_levels[level]}
+            goal_nodes = [nodes[lid] for lid in goal_ids]
+            if not any(n1.is_mutex(n2) for i, n1 in enumerate(goal_nodes) for n2 in goal_nodes[i + 1:]):
+                return level
+            # from the level where the literals leveled off on, consecutive levels hold the same
+            # literals, so equal mutex counts mean the mutex relation has leveled off too
+            if self.leveled_level is not None and level >= self.leveled_level and \
+                    sum(len(n.mutex) for n in self.s_levels[level]) == \
+                    sum(len(n.mutex) for n in self.s_levels[level - 1]):
+                return UNREACHABLE
+            level += 1
+
+    def h_ff(self) -> int:
+        '''The number of actions in a relaxed plan extracted backwards from the goals (FF heuristic)
+
+        Each subgoal at level k > 0 is achieved by the easiest action (smallest sum of precondition
+        levels) that first becomes applicable at level k - 1; its preconditions become subgoals at
+        their own first levels, and its effects count as achieved at levels k and k - 1.
+
+        :return: int
+        '''
+        index = self.index
+        goals = {}
+        for this_goal in self.problem.goal:
+            lid = index.literal_id(this_goal)
+            level = self.level_of(lid)
+            if level:
+                goals.setdefault(level, set()).add(lid)
+        first = self.first_level
+        achieved = {}
+        plan_length = 0
+        for level in range(max(goals, default=0), 0, -1):
+            for lid in sorted(goals.get(level, ())):
+                if lid in achieved.get(level, ()):
+                    continue
+                best = None
+                for aid in index.effect_actions[lid]:
+                    pre_levels = [first.get(pid) for pid in index.pre_ids[aid]]
+                    if None in pre_levels or max(pre_levels, default=0) != level - 1:
+                        continue
+                    difficulty = sum(pre_levels)
+                    if best is None or difficulty < best[0]:
+                        best = (difficulty, aid)
+                aid = best[1]
+                plan_length += 1
+                for pid in index.pre_ids[aid]:
+                    if first[pid] and pid not in achieved.get(level - 1, ()):
+                        goals.setdefault(first[pid], set()).add(pid)
+                for eid in index.eff_ids[aid]:
+                    achieved.setdefault(level, set()).add(eid)
+                    achieved.setdefault(level - 1, set()).add(eid)
+        return plan_length
+
+
+class PgProblemIndex():
+    '''
+    Integer encoding of a planning problem, shared by every IndexedPlanningGraph
+    built for that problem.
+
+    Literal ids: the fluent at position i of problem.state_map is literal i when
+    positive and literal n + i when negative (n fluents), so a T/F state string
+    maps directly onto the first S level.  Action ids follow the order of
+    PlanningGraph.all_actions: the problem's ground actions, then the no-ops.
+    '''
+
+    def __init__(self, problem: Problem):
+        '''
+        :param problem: PlanningProblem (or subclass such as AirCargoProblem or HaveCakeProblem)
+        Instance variables calculated:
+            fluent_id: dict expr -> int, position of each fluent in problem.state_map
+            actions: list of Action, the ground actions followed by the no-op actions
+            pre, eff: bool matrices (actions x literals) of precondition and effect literals
+            pre_count: int vector, number of precondition literals of each action
+            pre_ids, eff_ids: list of tuples, the precondition / effect literal ids of each action
+            precond_actions: list of lists, the ids of the actions having each literal as a precondition
+            effect_actions: list of lists, the ids of the actions having each literal as an effect
+            is_persistent: bool vector, True for actions whose effects equal their preconditions
+            static_relations: dict rule name -> bool matrix (actions x actions) of each pair
+                relation that does not depend on the state: 'inconsistent_effects',
+                'interference' and 'competing_needs' (its precondition-negation part)
+            static_mutex: bool matrix (actions x actions), the union of the static relations
+            static_mutex_ids: list of frozensets, the same relation as the ids mutex with each action
+            literal_templates: list of PgLiteralTemplate, immutable identity of each literal id
+            action_templates: list of PgActionTemplate, immutable identity, precondition and effect
+                ids and possible S-nodes of each action id, shared by all PlanningGraph nodes
+            nonpersistent_pair: bool matrix (actions x actions), pairs mutex in a serial graph
+        '''
+        self.problem = problem
+        self.fluents = list(problem.state_map)
+        self.num_fluents = len(self.fluents)
+        self.num_literals = 2 * self.num_fluents
+        self.fluent_id = {fluent: i for i, fluent in enumerate(self.fluents)}
+        self.actions = problem.actions_list + PlanningGraph.noop_actions(self.fluents)
+        self.action_id = {(a.name, a.args): i for i, a in enumerate(self.actions)}
+
+        n = self.num_fluents
+        num_actions = len(self.actions)
+        pre_pos = np.zeros((num_actions, n), dtype=bool)
+        pre_neg = np.zeros((num_actions, n), dtype=bool)
+        add = np.zeros((num_actions, n), dtype=bool)
+        rem = np.zeros((num_actions, n), dtype=bool)
+        for i, action in enumerate(self.actions):
+            pre_pos[i, [self.fluent_id[f] for f in action.precond_pos]] = True
+            pre_neg[i, [self.fluent_id[f] for f in action.precond_neg]] = True
+            add[i, [self.fluent_id[f] for f in action.effect_add]] = True
+            rem[i, [self.fluent_id[f] for f in action.effect_rem]] = True
+        self.pre = np.hstack((pre_pos, pre_neg))
+        self.eff = np.hstack((add, rem))
+        self.pre_count = self.pre.sum(axis=1)
+        self.pre_ids = [tuple(int(lid) for lid in np.flatnonzero(row)) for row in self.pre]
+        self.eff_ids = [tuple(int(lid) for lid in np.flatnonzero(row)) for row in self.eff]
+        self.precond_actions = [[] for _ in range(self.num_literals)]
+        for aid, pre_ids in enumerate(self.pre_ids):
+            for lid in pre_ids:
+                self.precond_actions[lid].append(aid)
+        self.effect_actions = [[] for _ in range(self.num_literals)]
+        for aid, eff_ids in enumerate(self.eff_ids):
+            for lid in eff_ids:
+                self.effect_actions[lid].append(aid)
+        self.is_persistent = np.all(self.pre == self.eff, axis=1)
+
+        # same pair tests as PlanningGraph.inconsistent_effects_mutex, interference_mutex and
+        # the static half of competing_needs_mutex, evaluated in both orders
+        self.static_relations = {
+            'inconsistent_effects': _bool_product(add, rem),
+            'interference': _bool_product(rem, pre_pos) | _bool_product(add, pre_neg),
+            'competing_needs': _bool_product(pre_pos, pre_neg)}
+        for relation in self.static_relations.values():
+            relation |= relation.T
+            np.fill_diagonal(relation, False)
+        static = np.logical_or.reduce(list(self.static_relations.values()))
+        self.static_mutex = static
+        self.static_mutex_ids = [frozenset(int(aid) for aid in np.flatnonzero(row)) for row in static]
+        self.nonpersistent_pair = np.outer(~self.is_persistent, ~self.is_persistent)
+        np.fill_diagonal(self.nonpersistent_pair, False)
+
+        self.literal_templates = []
+        for lid in range(self.num_literals):
+            fluent = self.fluents[lid % n]
+            is_pos = lid < n
+            literal = fluent if is_pos else expr('~{}'.format(fluent))
+            self.literal_templates.append(PgLiteralTemplate(lid, fluent, is_pos, literal))
+        possible_nodes = [PgNode_s.from_template(t) for t in self.literal_templates]
+        self.action_templates = []
+        for aid, action in enumerate(self.actions):
+            self.action_templates.append(PgActionTemplate(
+                aid, action, self.pre_ids[aid], self.eff_ids[aid],
+                frozenset(possible_nodes[lid] for lid in self.pre_ids[aid]),
+                frozenset(possible_nodes[lid] for lid in self.eff_ids[aid]),
+                bool(self.is_persistent[aid])))
+
+    def encode(self, state: str) -> np.ndarray:
+        '''S0 literal vector for a state string
+
+        :param state: str (will be in form TFTTFF... representing fluent states)
+        :return: bool vector over literal ids
+        '''
+        pos = np.frombuffer(state.encode('ascii'), dtype=np.uint8) == ord('T')
+        return np.concatenate((pos, ~pos))
+
+    def literal_id(self, fluent, is_pos=True) -> int:
+        '''literal id of a fluent expr
+
+        :param fluent: expr
+        :param is_pos: bool
+        :return: int
+        '''
+        i = self.fluent_id[fluent]
+        return i if is_pos else i + self.num_fluents
+
+
+def _bool_product(m1: np.ndarray, m2: np.ndarray) -> np.ndarray:
+    '''boolean matrix product m1 . m2.T: True where a row of m1 shares a set column with a row of m2'''
+    return (m1.astype(np.int32) @ m2.T.astype(np.int32)) > 0
+
+
+def batch_levelsum(problem: Problem, states: list) -> np.ndarray:
+    ''' h_levelsum of many states at once by vectorized relaxed reachability
+
+    All states advance one level per step together: the satisfied precondition counts of
+    every (state, action) pair and the literals of the next level are two matrix products
+    over the action/literal incidence matrices of the problem index.  A state drops out of
+    the batch once all goals have appeared or its levels stop changing.  The values equal
+    PlanningGraph(problem, state).h_levelsum() for each state.
+
+    :param problem: PlanningProblem
+    :param states: list of str (will be in form TFTTFF... representing fluent states)
+    :return: int vector of level sums, in the order of `states`
+    '''
+    index = problem_index(problem)
+    if not states:
+        return np.zeros(0, dtype=np.int64)
+    literals = np.stack([index.encode(state) for state in states])
+    goal_ids = np.array([index.literal_id(goal) for goal in problem.goal], dtype=np.int64)
+    first = np.where(literals[:, goal_ids], 0, -1)
+    active = ~(first >= 0).all(axis=1)
+    pre = index.pre.T.astype(np.float32)
+    eff = index.eff.astype(np.float32)
+    level = 0
+    while active.any():
+        level += 1
+        rows = np.flatnonzero(active)
+        current = literals[rows]
+        enabled = (current.astype(np.float32) @ pre) >= index.pre_count
+        reached = ((enabled.astype(np.float32) @ eff) > 0) | current
+        changed = (reached != current).any(axis=1)
+        literals[rows] = reached
+        found = reached[:, goal_ids] & (first[rows] < 0)
+        first[rows] = np.where(found, level, first[rows])
+        done = (first[rows] >= 0).all(axis=1) | ~changed
+        active[rows[done]] = False
+    return np.where(first >= 0, first, 0).sum(axis=1)
+
+
+def problem_index(problem: Problem) -> PgProblemIndex:
+    '''PgProblemIndex of the problem, built on first use and cached on the problem
+
+    :param problem: PlanningProblem
+    :return: PgProblemIndex
+    '''
+    index = getattr(problem, 'pg_index', None)
+    if index is None:
+        index = PgProblemIndex(problem)
+        problem.pg_index = index
+    return index
+
+
+class IndexedPlanningGraph():
+    '''
+    Compact planning graph over the integer ids of a PgProblemIndex.
+
+    Builds the same levels as PlanningGraph, but each level is a boolean vector
+    over literal (S) or action (A) ids and the mutex relation of a level is a
+    boolean matrix over the ids present in that level, so every construction
+    step is a handful of vectorized NumPy operations.  h_levelsum returns the
+    same value as PlanningGraph.h_levelsum.
+    '''
+
+    def __init__(self, problem: Problem, state: str, serial_planning=True):
+        '''
+        :param problem: PlanningProblem (or subclass such as AirCargoProblem or HaveCakeProblem)
+        :param state: str (will be in form TFTTFF... representing fluent states)
+        :param serial_planning: bool (whether or not to assume that only one action can occur at a time)
+        Instance variable calculated:
+            index: PgProblemIndex shared by all graphs of the problem
+            s_levels: list of bool vectors over literal ids, one per S-level
+            a_levels: list of bool vectors over action ids, one per A-level
+            s_ids, a_ids: list of int vectors, the ids present in each level
+            s_mutex, a_mutex: list of bool matrices over s_ids[level] / a_ids[level]
+        '''
+        self.problem = problem
+        self.index = problem_index(problem)
+        self.serial = serial_planning
+        self.s_levels = []
+        self.a_levels = []
+        self.s_ids = []
+        self.a_ids = []
+        self.s_mutex = []
+        self.a_mutex = []
+        self.create_graph(self.index.encode(state))
+
+    def create_graph(self, s0: np.ndarray):
+        ''' build the graph alternating A, S levels until the last two S levels contain the same literals
+
+        :param s0: bool vector over literal ids
+        :return:
+            fills the level and mutex lists
+        '''
+        level = 0
+        self.s_levels.append(s0)
+        self.s_ids.append(np.flatnonzero(s0))
+        self.s_mutex.append(np.zeros((len(self.s_ids[0]), len(self.s_ids[0])), dtype=bool))
+        leveled = False
+        while not leveled:
+            self.add_action_level(level)
+            self.update_a_mutex(level)
+
+            level += 1
+            self.add_literal_level(level)
+            self.update_s_mutex(level)
+
+            if np.array_equal(self.s_levels[level], self.s_levels[level - 1]):
+                leveled = True
+
+    def add_action_level(self, level):
+        ''' add the A level enabled by S level `level`
+
+        An action enters the level when all of its preconditions are present.
+
+        :param level: int
+        '''
+        satisfied = self.index.pre.astype(np.int32) @ self.s_levels[level].astype(np.int32)
+        enabled = satisfied == self.index.pre_count
+        self.a_levels.append(enabled)
+        self.a_ids.append(np.flatnonzero(enabled))
+
+    def add_literal_level(self, level):
+        ''' add S level `level` holding every effect of the previous A level
+
+        :param level: int
+        '''
+        literals = self.index.eff[self.a_ids[level - 1]].any(axis=0)
+        self.s_levels.append(literals)
+        self.s_ids.append(np.flatnonzero(literals))
+
+    def update_a_mutex(self, level):
+        ''' mutex matrix of A level `level`: serial pairs, the static relation of the
+        problem index, and competing needs between the parents present in the previous S level
+
+        :param level: int
+        '''
+        ids = self.a_ids[level]
+        mutex = self.index.static_mutex[np.ix_(ids, ids)].copy()
+        if self.serial:
+            mutex |= self.index.nonpersistent_pair[np.ix_(ids, ids)]
+        parents = self.index.pre[np.ix_(ids, self.s_ids[level])].astype(np.int32)
+        mutex |= (parents @ self.s_mutex[level].astype(np.int32) @ parents.T) > 0
+        np.fill_diagonal(mutex, False)
+        self.a_mutex.append(mutex)
+
+    def update_s_mutex(self, level):
+        ''' mutex matrix of S level `level`: negation and inconsistent support
+
+        :param level: int
+        '''
+        ids = self.s_ids[level]
+        n = self.index.num_fluents
+        mutex = (ids[:, None] % n) == (ids[None, :] % n)
+        achievers = self.index.eff[np.ix_(self.a_ids[level - 1], ids)].astype(np.int32)
+        compatible = (~self.a_mutex[level - 1]).astype(np.int32)
+        mutex |= (achievers.T @ compatible @ achievers) == 0
+        np.fill_diagonal(mutex, False)
+        self.s_mutex.append(mutex)
+
+    def first_levels(self, literal_ids) -> list:
+        '''first S level containing each literal, or None if it never appears
+
+        :param literal_ids: iterable of int
+        :return: list of int or None
+        '''
+        levels = np.array(self.s_levels)
+        first = []
+        for lid in literal_ids:
+            hits = np.flatnonzero(levels[:, lid])
+            first.append(int(hits[0]) if len(hits) else None)
+        return first
+
+    def h_levelsum(self) -> int:
+        '''The sum of the level costs of the individual goals (admissible if goals independent)
+
+        :return: int
+        '''
+        goal_ids = [self.index.literal_id(goal) for goal in self.problem.goal]
+        return sum(lv for lv in self.first_levels(goal_ids) if lv is not None)
+
+
+class RelaxedPlanningGraph():
+    '''
+    Relaxed reachability levels of a state: the index of the first S level of
+    the planning graph at which each literal appears, without mutexes.  These are
+    the only part of the graph h_levelsum needs.
+
+    A graph for a successor state can be derived from its parent's with child(),
+    which repairs only the levels that depend on the literals the action changed
+    and falls back to a full computation when that region is too large.
+    '''
+
+    def __init__(self, problem: Problem, state: str, levels=None):
+        '''
+        :param problem: PlanningProblem (or subclass such as AirCargoProblem or HaveCakeProblem)
+        :param state: str (will be in form TFTTFF... representing fluent states)
+        :param levels: list of int, precomputed levels of the state (used by child())
+        Instance variable calculated:
+            index: PgProblemIndex shared by all graphs of the problem
+            levels: list over literal ids of the first level of each literal, UNREACHABLE if none
+            incremental: bool, True if the levels were repaired from a parent graph
+        '''
+        self.problem = problem
+        self.index = problem_index(problem)
+        self.state = state
+        self.incremental = levels is not None
+        self.levels = levels if levels is not None else self.compute_levels()
+
+    def s0_ids(self, state: str) -> list:
+        '''literal ids holding in a state'''
+        n = self.index.num_fluents
+        return [i if value == 'T' else n + i for i, value in enumerate(state)]
+
+    def compute_levels(self) -> list:
+        ''' first level of every literal, expanding one layer at a time from S0
+
+        :return: list of int or UNREACHABLE
+        '''
+        index = self.index
+        levels = [UNREACHABLE] * index.num_literals
+        remaining = [len(pre_ids) for pre_ids in index.pre_ids]
+        ready = [aid for aid, count in enumerate(remaining) if count == 0]
+        frontier = self.s0_ids(self.state)
+        for lid in frontier:
+            levels[lid] = 0
+        level = 0
+        while frontier or ready:
+            for lid in frontier:
+                for aid in index.precond_actions[lid]:
+                    remaining[aid] -= 1
+                    if remaining[aid] == 0:
+                        ready.append(aid)
+            frontier = []
+            for aid in ready:
+                for lid in index.eff_ids[aid]:
+                    if levels[lid] == UNREACHABLE:
+                        levels[lid] = level + 1
+                        frontier.append(lid)
+            ready = []
+            level += 1
+        return levels
+
+    def action_level(self, levels: list, aid: int):
+        '''first A level of an action: the latest first level of its preconditions'''
+        return max((levels[lid] for lid in self.index.pre_ids[aid]), default=0)
+
+    def child(self, state: str, rebuild_fraction=0.25):
+        ''' relaxed planning graph of a successor state, repaired from this graph
+
+        Literals leaving S0 can only raise levels: every literal whose level may have been
+        supported through them is reset and recomputed from its unaffected achievers.
+        Literals entering S0 can only lower levels, which is propagated outwards from them.
+
+        :param state: str, the successor state
+        :param rebuild_fraction: float, share of the literals that may be reset before the
+            levels are recomputed from scratch instead
+        :return: RelaxedPlanningGraph
+        '''
+        index = self.index
+        old = self.levels
+        parent_s0 = set(self.s0_ids(self.state))
+        child_s0 = set(self.s0_ids(state))
+        removed = parent_s0 - child_s0
+        added = child_s0 - parent_s0
+
+        # literals whose level may rise: the effects an action with an affected precondition
+        # supports at their level.  Every such action counts, not only those whose latest
+        # precondition is affected, as the affected literal may rise past the others
+        affected = set(removed)
+        stack = list(removed)
+        while stack:
+            lid = stack.pop()
+            for aid in index.precond_actions[lid]:
+                level = self.action_level(old, aid)
+                for eid in index.eff_ids[aid]:
+                    if eid not in affected and old[eid] == level + 1:
+                        affected.add(eid)
+                        stack.append(eid)
+            if len(affected) > rebuild_fraction * index.num_literals:
+                return RelaxedPlanningGraph(self.problem, state)
+
+        levels = list(old)
+        for lid in affected:
+            levels[lid] = UNREACHABLE
+        queue = []
+        unresolved = {}
+        for lid in affected:
+            for aid in index.effect_actions[lid]:
+                pending = sum(1 for pid in index.pre_ids[aid] if pid in affected)
+                if pending:
+                    unresolved[aid] = pending
+                    continue
+                level = self.action_level(levels, aid) + 1
+                if level < levels[lid]:
+                    levels[lid] = level
+            if levels[lid] != UNREACHABLE:
+                heapq.heappush(queue, (levels[lid], lid))
+        done = set()
+        while queue:
+            level, lid = heapq.heappop(queue)
+            if lid in done or level > levels[lid]:
+                continue
+            done.add(lid)
+            for aid in index.precond_actions[lid]:
+                if aid not in unresolved:
+                    continue
+                unresolved[aid] -= 1
+                if unresolved[aid]:
+                    continue
+                level = self.action_level(levels, aid) + 1
+                for eid in index.eff_ids[aid]:
+                    if eid in affected and eid not in done and level < levels[eid]:
+                        levels[eid] = level
+                        heapq.heappush(queue, (level, eid))
+
+        # literals entering S0 lower the levels that can be reached through them
+        queue = []
+        for lid in added:
+            if levels[lid] > 0:
+                levels[lid] = 0
+                queue.append((0, lid))
+        while queue:
+            level, lid = heapq.heappop(queue)
+            if level > levels[lid]:
+                continue
+            for aid in index.precond_actions[lid]:
+                level = self.action_level(levels, aid) + 1
+                for eid in index.eff_ids[aid]:
+                    if level < levels[eid]:
+                        levels[eid] = level
+                        heapq.heappush(queue, (level, eid))
+        return RelaxedPlanningGraph(self.problem, state, levels)
+
+    def h_levelsum(self) -> int:
+        '''The sum of the level costs of the individual goals (admissible if goals independent)
+
+        :return: int
+        '''
+        level_sum = 0
+        for goal in self.problem.goal:
+            level = self.levels[self.index.literal_id(goal)]
+            if level != UNREACHABLE:
+                level_sum += level
         return level_sum
+
+
+class GraphPlan():
+    '''
+    GraphPlan solver (Russell-Norvig 3rd Ed 10.3.1 or 2nd Ed 11.4) running backward
+    plan extraction on a PlanningGraph.
+
+    Failed goal sets are memoized per level as no-goods; the graph is extended one
+    level at a time until a plan is extracted, or until the graph has leveled off and
+    the no-good table of the level-off level stops growing between two extraction
+    stages, which proves there is no plan.
+    '''
+
+    def __init__(self, problem: Problem, serial_planning=True):
+        '''
+        :param problem: PlanningProblem (or subclass such as AirCargoProblem or HaveCakeProblem)
+        :param serial_planning: bool (with False, independent actions may share a step and the
+            plan is returned as parallel steps)
+        Instance variable calculated:
+            graph: PlanningGraph of the initial state, extended on demand
+            nogoods: list over S levels of the sets of goal-id frozensets known to be unachievable
+        '''
+        self.problem = problem
+        self.graph = PlanningGraph(problem, problem.initial, serial_planning, goal_directed=True)
+        self.index = self.graph.index
+        self.nogoods = []
+
+    def solve(self):
+        ''' extract a plan, extending the graph until one exists or none can
+
+        :return: list of lists of Action, one list per step in execution order (the actions
+            of a step may run in any order); no-op actions are left out and empty steps
+            dropped; None if the problem has no solution
+        '''
+        goals = frozenset(self.index.literal_id(goal) for goal in self.problem.goal)
+        if any(self.graph.level_of(lid) is None for lid in goals):
+            return None
+        level = max(self.graph.first_level[lid] for lid in goals)
+        while len(self.graph.s_levels) <= level:
+            self.graph.expand_level(force=True)
+        level_off = None
+        previous_count = None
+        while True:
+            steps = self.extract(goals, level)
+            if steps is not None:
+                return [[anode.action for anode in step if not anode.is_persistent]
+                        for step in steps if any(not anode.is_persistent for anode in step)]
+            if level_off is None:
+                level_off = self.level_off()
+            if level_off is not None:
+                count = len(self.nogoods[level_off]) if level_off < len(self.nogoods) else 0
+                if count == previous_count:
+                    return None
+                previous_count = count
+            self.graph.expand_level(force=True)
+            level += 1
+
+    def level_off(self):
+        ''' first S level identical to the previous one in both literals and mutex pairs
+
+        :return: int, or None if the graph built so far has not leveled off
+        '''
+        s_levels = self.graph.s_levels
+        for level in range(1, len(s_levels)):
+            if s_levels[level] == s_levels[level - 1] and \
+                    sum(len(n.mutex) for n in s_levels[level]) == sum(len(n.mutex) for n in s_levels[level - 1]):
+                return level
+        return None
+
+    def extract(self, goals: frozenset, level: int):
+        ''' backward search for steps achieving the goal literals at an S level
+
+        :param goals: frozenset of literal ids
+        :param level: int
+        :return: list of lists of PgNode_a (one per A level 0 .. level - 1), or None
+        '''
+        if level == 0:
+            return []
+        while len(self.nogoods) <= level:
+            self.nogoods.append(set())
+        if goals in self.nogoods[level]:
+            return None
+        nodes = {node.lid: node for node in self.graph.s_levels[level]}
+        goal_nodes = [nodes.get(lid) for lid in sorted(goals)]
+        if None in goal_nodes or any(n1.is_mutex(n2) for i, n1 in enumerate(goal_nodes)
+                                     for n2 in goal_nodes[i + 1:]):
+            self.nogoods[level].add(goals)
+            return None
+        steps = self.assign(goal_nodes, 0, [], level)
+        if steps is None:
+            self.nogoods[level].add(goals)
+        return steps
+
+    def assign(self, goal_nodes: list, i: int, chosen: list, level: int):
+        ''' choose pairwise compatible achievers for goal_nodes[i:] and recurse to the previous level
+
+        Persistent (no-op) achievers are tried first.
+
+        :return: list of lists of PgNode_a, or None
+        '''
+        if i == len(goal_nodes):
+            subgoals = frozenset(lid for anode in chosen for lid in self.index.pre_ids[anode.aid])
+            steps = self.extract(subgoals, level - 1)
+            return None if steps is None else steps + [list(chosen)]
+        goal = goal_nodes[i]
+        if any(goal.lid in self.index.eff_ids[anode.aid] for anode in chosen):
+            return self.assign(goal_nodes, i + 1, chosen, level)
+        for anode in sorted(goal.parents, key=lambda a: (not a.is_persistent, a.aid)):
+            if any(anode.is_mutex(other) for other in chosen):
+                continue
+            chosen.append(anode)
+            steps = self.assign(goal_nodes, i + 1, chosen, level)
+            chosen.pop()
+            if steps is not None:
+                return steps
+        return None
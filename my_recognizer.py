@@ -1,5 +1,15 @@
+import heapq
+import math
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 from asl_data import SinglesData
+from my_hmm_scoring import CompositeHMM, StackedHMMs, logsumexp
+from my_language_model import SENTENCE_END, SENTENCE_START
+from my_model_selectors import attach_word_data, share_word_data
+
+FAILED_LOGL = -9999999999
 
 
 def recognize(models: dict, test_set: SinglesData):
@@ -40,3 +50,203 @@ def recognize(models: dict, test_set: SinglesData):
             current_logl = current_test_word_logl[each_guess]
        guesses.append(best_word) 
     return (probabilities, guesses)
+
+
+def recognize_batch(models: dict, test_set: SinglesData, batch_size=64, n_jobs=1, top_k=None,
+                    beam=None, stats=None):
+    """ Recognize test word sequences like recognize, scoring batches of items at once
+
+    All models are stacked into a StackedHMMs, which scores a whole batch of test items under
+    every model in one vectorized forward pass.  With n_jobs != 1 the batches are spread over
+    worker processes that receive the stacked models once and read the test frames from a
+    shared memory block.  With a beam, each item is scored by StackedHMMs.score_pruned, which
+    abandons words that fall too far behind; pruned words score -inf.
+
+    :param models: dict of trained models, as for recognize, or a StackedHMMs (e.g. loaded with
+        StackedHMMs.load); models must be diagonal GaussianHMMs and words whose model is None
+        score FAILED_LOGL
+    :param test_set: SinglesData object
+    :param batch_size: int, number of test items per forward pass
+    :param n_jobs: int, number of worker processes; 1 scores in this process, None uses all CPUs
+    :param top_k: int, keep only the k best words per item; None keeps every word
+    :param beam: float log-likelihood margin for pruning, or None for exact scores
+    :param stats: dict, if given its 'evaluated' and 'saved' counts of frame-model emission
+        evaluations are increased
+    :return: (list, list) as probabilities, guesses, ordered as in recognize; with top_k each
+        probabilities dict holds the k best words only, best first
+    """
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    stacked = models if isinstance(models, StackedHMMs) else StackedHMMs(models)
+    words = list(models) if isinstance(models, dict) else stacked.words + stacked.missing
+    items = list(test_set._data)
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    if n_jobs == 1:
+        results = [_score_batch(stacked, [test_set.get_item_Xlengths(item) for item in batch], beam)
+                   for batch in batches]
+    else:
+        block, layout = share_word_data({item: test_set.get_item_Xlengths(item) for item in items})
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_recognizer_worker,
+                                     initargs=(block.name, layout, stacked, beam)) as executor:
+                results = list(executor.map(_score_items, batches))
+        finally:
+            block.close()
+            block.unlink()
+    if stats is not None:
+        stats['evaluated'] = stats.get('evaluated', 0) + sum(result[1] for result in results)
+        stats['saved'] = stats.get('saved', 0) + sum(result[2] for result in results)
+    scores = np.concatenate([result[0] for result in results]) if results else np.zeros((0, len(stacked.words)))
+    # NaN scores (degenerate models) never win, as with the comparisons in recognize
+    ranking = np.where(np.isnan(scores), -np.inf, scores)
+    probabilities = []
+    guesses = []
+    for row, ranks in zip(scores.tolist(), ranking):
+        if top_k is None:
+            logL = dict(zip(stacked.words, row))
+            probabilities.append({word: logL.get(word, FAILED_LOGL) for word in words})
+        else:
+            best = np.argsort(-ranks, kind="stable")[:top_k]
+            probabilities.append({stacked.words[k]: row[k] for k in best})
+        guesses.append(stacked.words[int(np.argmax(ranks))] if stacked.words else None)
+    return (probabilities, guesses)
+
+
+def recognize_sentences(probabilities: list, test_set: SinglesData, language_model, beam_width=10,
+                        lm_weight=1.0, candidates=None):
+    """ Recognize test words sentence by sentence with a language model and a beam search
+
+    Each sentence of test_set.sentences_index is decoded left to right.  Every hypothesis is
+    extended by the `candidates` best words of the next item by HMM score, scored as the sum
+    of HMM log-likelihoods plus lm_weight times the language model log-probability, and only
+    the beam_width best hypotheses are kept.  Hypotheses ending in the same n - 1 words have
+    the same future and are merged, so the work per sentence is linear in its length.
+
+    :param probabilities: list of dicts of word -> log-likelihood, as returned by recognize or
+        recognize_batch (with or without top_k)
+    :param test_set: SinglesData object
+    :param language_model: NGramModel, e.g. trained on load_training_sentences()
+    :param beam_width: int, number of hypotheses kept after each word
+    :param lm_weight: float scale of the language model log-probabilities
+    :param candidates: int, words tried per item; defaults to beam_width
+    :return: list of guesses ordered like those of recognize; items outside every sentence
+        keep their best HMM word
+    """
+    index = {item: n for n, item in enumerate(test_set._data)}
+    options = []
+    for logL in probabilities:
+        scored = [(word, value) for word, value in logL.items() if not math.isnan(value)]
+        options.append(heapq.nlargest(candidates or beam_width, scored, key=lambda option: option[1]))
+    guesses = [best[0][0] if best else None for best in options]
+    context = language_model.n - 1
+    for items in test_set.sentences_index.values():
+        # hypotheses as language model state (last n - 1 words) -> (score, words)
+        beam = {(SENTENCE_START,) * context: (0.0, ())}
+        for item in items:
+            extended = {}
+            for state, (score, words) in beam.items():
+                for word, logL in options[index[item]]:
+                    total = score + logL + lm_weight * language_model.log_prob(word, state)
+                    next_state = (state + (word,))[1:] if context else ()
+                    if next_state not in extended or total > extended[next_state][0]:
+                        extended[next_state] = (total, words + (word,))
+            if not extended:
+                break
+            beam = dict(heapq.nlargest(beam_width, extended.items(), key=lambda hypothesis: hypothesis[1][0]))
+        else:
+            _, words = max(((score + lm_weight * language_model.log_prob(SENTENCE_END, state), words)
+                            for state, (score, words) in beam.items()), key=lambda hypothesis: hypothesis[0])
+            for item, word in zip(items, words):
+                guesses[index[item]] = word
+    return guesses
+
+
+def recognize_continuous(models: dict, test_set: SinglesData, word_penalty=None):
+    """ Recognize whole sentences without word segmentation
+
+    The frames of the items of each sentence in test_set.sentences_index are joined into one
+    sequence, which CompositeHMM.decode splits into words in a single Viterbi pass.
+
+    :param models: dict of trained models, as for recognize_batch
+    :param test_set: SinglesData object
+    :param word_penalty: float log-probability added at each word boundary, or None for
+        CompositeHMM's automatic penalty; see CompositeHMM for tuning it
+    :return: dict of sentence -> list of (word, first frame, last frame) in the joined frames
+    """
+    composite = CompositeHMM(models, word_penalty)
+    decoded = {}
+    for sentence, items in test_set.sentences_index.items():
+        X = np.concatenate([test_set.get_item_Xlengths(item)[0] for item in items])
+        decoded[sentence] = composite.decode(X)[0]
+    return decoded
+
+
+class StreamingRecognizer(object):
+    '''
+    online recognition of a sign whose feature frames arrive one at a time
+
+    The forward log-variables of every word model are kept between frames, so each `push`
+    costs one emission evaluation and one forward step per model, however long the segment
+    already is.  `reset` starts a new segment, e.g. when the video pipeline detects a pause.
+
+    :param models: dict of trained models as for recognize, or a StackedHMMs
+    '''
+
+    def __init__(self, models):
+        self.stacked = models if isinstance(models, StackedHMMs) else StackedHMMs(models)
+        self.reset()
+
+    def reset(self):
+        """ forget the frames of the current segment """
+        self.log_alpha = None
+        self.frames = 0
+        self.scores = np.zeros(len(self.stacked.words))
+
+    def push(self, frame):
+        """ advance every word model by one feature frame
+
+        :param frame: sequence of feature values
+        :return: str, the best guess for the segment so far
+        """
+        self.log_alpha = self.stacked.step(self.log_alpha, frame)
+        self.scores = logsumexp(self.log_alpha, axis=1)
+        self.frames += 1
+        return self.guess()
+
+    def guess(self):
+        """ best word for the segment so far, None before the first frame """
+        if not self.frames or not self.stacked.words:
+            return None
+        return self.stacked.words[int(np.argmax(np.where(np.isnan(self.scores), -np.inf, self.scores)))]
+
+    def best(self, k=1):
+        """ the k best words for the segment so far
+
+        :return: list of (word, log-likelihood) pairs, best first
+        """
+        if not self.frames:
+            return []
+        ranking = np.where(np.isnan(self.scores), -np.inf, self.scores)
+        return [(self.stacked.words[i], float(self.scores[i])) for i in np.argsort(-ranking, kind="stable")[:k]]
+
+
+_recognizer_worker = {}
+
+
+def _init_recognizer_worker(name, layout, stacked, beam):
+    block, _, Xlengths = attach_word_data(name, layout)
+    _recognizer_worker.update(block=block, Xlengths=Xlengths, stacked=stacked, beam=beam)
+
+
+def _score_items(items):
+    worker = _recognizer_worker
+    return _score_batch(worker['stacked'], [worker['Xlengths'][item] for item in items], worker['beam'])
+
+
+def _score_batch(stacked, Xlengths, beam):
+    # (scores, evaluated, saved) for a batch of items
+    if beam is None:
+        frames = sum(len(X) for X, _ in Xlengths)
+        return stacked.score_batch(Xlengths), frames * len(stacked.words), 0
+    results = [stacked.score_pruned(X, lengths, beam) for X, lengths in Xlengths]
+    scores = np.array([result[0] for result in results]).reshape(len(results), len(stacked.words))
+    return scores, sum(result[1] for result in results), sum(result[2] for result in results)
@@ -0,0 +1,150 @@
+import json
+import platform
+import time
+import tracemalloc
+import warnings
+from collections import defaultdict
+from timeit import default_timer as timer
+
+import numpy as np
+
+
+def benchmark_word(model_selector, all_word_sequences: dict, all_word_Xlengths: dict, word: str,
+                   trace_memory=True, **selector_kwargs) -> dict:
+    """ Run one selector on one word and profile it through the selector's fit_log
+
+    :param model_selector: ModelSelector subclass, e.g. SelectorBIC
+    :param trace_memory: bool, record the peak of memory allocated during selection with
+        tracemalloc (numpy allocations included); this slows selection down somewhat
+    :param selector_kwargs: passed on to the selector, e.g. min_n_components=2, max_n_components=15
+    :return: dict with the word, wall time, peak memory, fit count, fit time, EM iterations and
+        failed fits per n, failures swallowed by the selector and the selected n (None if selection
+        failed)
+    """
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    fit_log = []
+    started = trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    if trace_memory:
+        tracemalloc.reset_peak()
+    start = timer()
+    try:
+        model = model_selector(all_word_sequences, all_word_Xlengths, word, fit_log=fit_log,
+                               **selector_kwargs).select()
+    finally:
+        seconds = timer() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if started:
+            tracemalloc.stop()
+    fits = [record for record in fit_log if record['event'] == 'fit']
+    by_n = defaultdict(lambda: {'fits': 0, 'seconds': 0.0, 'iterations': [], 'failed': 0, 'cached': 0})
+    for record in fits:
+        entry = by_n[record['num_states']]
+        entry['fits'] += 1
+        entry['seconds'] += record['seconds']
+        entry['failed'] += record['failed']
+        entry['cached'] += record['cached']
+        if record['iterations'] is not None:
+            entry['iterations'].append(record['iterations'])
+    return {'word': word,
+            'seconds': seconds,
+            'peak_bytes': peak,
+            'fits': len(fits),
+            'fit_seconds': sum(record['seconds'] for record in fits),
+            'em_iterations': sum(sum(entry['iterations']) for entry in by_n.values()),
+            'failed_fits': sum(record['failed'] for record in fits),
+            'selector_failures': sum(record['event'] == 'failure' for record in fit_log),
+            'by_n': {str(n): by_n[n] for n in sorted(by_n)},
+            'selected_n': getattr(model, 'n_components', None)}
+
+
+def benchmark_selector(model_selector, all_word_sequences: dict, all_word_Xlengths: dict, words=None,
+                       trace_memory=True, **selector_kwargs) -> dict:
+    """ Run one selector over a vocabulary
+
+    :param words: list of words to select models for; None uses every word
+    :return: dict with the selector name, its settings, one benchmark_word result per word and
+        a summary of totals
+    """
+    words = list(all_word_sequences) if words is None else list(words)
+    results = [benchmark_word(model_selector, all_word_sequences, all_word_Xlengths, word, trace_memory,
+                              **selector_kwargs) for word in words]
+    selected = [result['selected_n'] for result in results if result['selected_n'] is not None]
+    summary = {key: sum(result[key] for result in results)
+               for key in ('seconds', 'fits', 'fit_seconds', 'em_iterations', 'failed_fits', 'selector_failures')}
+    summary['words'] = len(results)
+    summary['unselected'] = len(results) - len(selected)
+    summary['mean_selected_n'] = float(np.mean(selected)) if selected else None
+    summary['max_peak_bytes'] = max((result['peak_bytes'] or 0 for result in results), default=0) \
+        if trace_memory else None
+    return {'selector': model_selector.__name__,
+            'settings': {key: value for key, value in selector_kwargs.items()
+                         if isinstance(value, (bool, int, float, str, type(None)))},
+            'words': results,
+            'summary': summary}
+
+
+def run_benchmark(model_selectors: list, all_word_sequences: dict, all_word_Xlengths: dict,
+                  ranges=((2, 15),), words=None, path=None, trace_memory=True, **selector_kwargs) -> dict:
+    """ Benchmark several selectors over several n_components ranges and save the results
+
+    :param model_selectors: list of ModelSelector subclasses
+    :param ranges: (min_n_components, max_n_components) pairs to run every selector with
+    :param path: JSON file to write the results to, or None
+    :return: dict with the run's metadata and one benchmark_selector result per selector and range
+    """
+    runs = []
+    for model_selector in model_selectors:
+        for min_n, max_n in ranges:
+            runs.append(benchmark_selector(model_selector, all_word_sequences, all_word_Xlengths, words,
+                                           trace_memory, min_n_components=min_n, max_n_components=max_n,
+                                           **selector_kwargs))
+    report = {'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'runs': runs}
+    if path is not None:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+def compare_benchmarks(baseline: dict, current: dict, tolerance=0.2,
+                       metrics=('seconds', 'fits', 'em_iterations', 'max_peak_bytes')) -> list:
+    """ Find regressions between two run_benchmark reports (or the JSON files they were saved to)
+
+    Runs are matched by selector name and n_components range.
+
+    :param tolerance: float, relative increase of a summary metric counted as a regression
+    :return: list of (selector, (min_n, max_n), metric, baseline value, current value) regressions,
+        plus a (selector, range, 'selected_n', {word: baseline n}, {word: current n}) entry when
+        the selected n of any word changed
+    """
+    if isinstance(baseline, str):
+        with open(baseline) as f:
+            baseline = json.load(f)
+    if isinstance(current, str):
+        with open(current) as f:
+            current = json.load(f)
+
+    def key(run):
+        settings = run['settings']
+        return run['selector'], (settings.get('min_n_components'), settings.get('max_n_components'))
+
+    previous = {key(run): run for run in baseline['runs']}
+    regressions = []
+    for run in current['runs']:
+        old = previous.get(key(run))
+        if old is None:
+            continue
+        for metric in metrics:
+            before, after = old['summary'].get(metric), run['summary'].get(metric)
+            if before is not None and after is not None and after > before * (1 + tolerance):
+                regressions.append(key(run) + (metric, before, after))
+        old_selected = {result['word']: result['selected_n'] for result in old['words']}
+        changed = {result['word']: result['selected_n'] for result in run['words']
+                   if result['word'] in old_selected and old_selected[result['word']] != result['selected_n']}
+        if changed:
+            regressions.append(key(run) + ('selected_n', {word: old_selected[word] for word in changed}, changed))
+    return regressions
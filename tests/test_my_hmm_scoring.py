@@ -0,0 +1,46 @@
+import os
+import sys
+parent = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(parent))
+
+import unittest
+
+import numpy as np
+from hmmlearn.hmm import GaussianHMM
+
+from my_hmm_scoring import StackedHMMs
+
+
+def single_state_model(variance, num_features=4):
+    model = GaussianHMM(n_components=1, covariance_type="diag")
+    model.startprob_ = np.ones(1)
+    model.transmat_ = np.ones((1, 1))
+    model.means_ = np.zeros((1, num_features))
+    model.covars_ = np.full((1, num_features), variance)
+    return model
+
+
+class TestScorePruned(unittest.TestCase):
+
+    def test_no_beam_matches_score(self):
+        stacked = StackedHMMs({'wide': single_state_model(1.0), 'narrow': single_state_model(0.25)})
+        X = np.random.RandomState(0).randn(20, 4)
+        scores, evaluated, saved = stacked.score_pruned(X)
+        np.testing.assert_allclose(scores, stacked.score(X, [len(X)]))
+        self.assertEqual((evaluated, saved), (40, 0))
+
+    def test_models_differing_only_in_variance(self):
+        # the data come from the wide model, so it wins by far over the whole sequence; a
+        # narrow model's higher peak density must not get the wide one pruned early on
+        stacked = StackedHMMs({'wide': single_state_model(1.0), 'narrow': single_state_model(0.25)})
+        rng = np.random.RandomState(0)
+        for _ in range(200):
+            X = rng.randn(40, 4)
+            exact = stacked.score(X, [len(X)])
+            self.assertGreater(exact[0] - exact[1], 50)
+            scores, _, _ = stacked.score_pruned(X, beam=50)
+            self.assertAlmostEqual(scores[0], exact[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import sys
+parent = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(parent))
+
+import random
+import unittest
+
+from my_air_cargo_problems import air_cargo_p1, air_cargo_p3
+from my_planning_graph import PlanningGraph, RelaxedPlanningGraph, UNREACHABLE
+
+
+class TestRelaxedPlanningGraphChild(unittest.TestCase):
+
+    def assert_child_levels(self, problem, parent_state, state):
+        child = RelaxedPlanningGraph(problem, parent_state).child(state, rebuild_fraction=1.0)
+        self.assertTrue(child.incremental)
+        self.assertEqual(child.levels, RelaxedPlanningGraph(problem, state).compute_levels(),
+                         "{} -> {}".format(parent_state, state))
+
+    def test_child_removed_literal_not_latest_precondition(self):
+        self.assert_child_levels(air_cargo_p1(), "FTFFTFFFFTTT", "FFTFTTTFFFTT")
+
+    def test_child_random_states(self):
+        rng = random.Random(7)
+        for problem in (air_cargo_p1(), air_cargo_p3()):
+            n = len(problem.state_map)
+            for _ in range(500):
+                parent_state = "".join(rng.choice("TF") for _ in range(n))
+                state = "".join(rng.choice("TF") for _ in range(n))
+                self.assert_child_levels(problem, parent_state, state)
+
+
+class TestPlanningGraphHeuristics(unittest.TestCase):
+
+    def test_h_setlevel_unreachable_goal(self):
+        # no literal places cargo C1 anywhere, so its goal At(C1, JFK) can never hold
+        pg = PlanningGraph(air_cargo_p1(), "FTTTFFFFFFFF", mutex=True)
+        self.assertEqual(pg.h_setlevel(), UNREACHABLE)
+
+
+if __name__ == '__main__':
+    unittest.main()